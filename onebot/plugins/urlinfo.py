@@ -9,23 +9,63 @@ This plugin shows information about urls posted.
 
 """
 
+import asyncio
+import codecs
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import concurrent.futures.process
+import concurrent.futures
 from contextlib import closing
+import functools
+import html
+import json
 import logging
 import os
 import re
 import pickle
 import ipaddress
 import socket
+import sqlite3
+import struct
+import threading
 import time
+import zlib
 import datetime
-from io import StringIO
-from typing import Callable, List, Optional, Self, Tuple
-from urllib.parse import urlparse, parse_qs
+from html.parser import HTMLParser
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    List,
+    Optional,
+    Self,
+    Set,
+    Tuple,
+)
+from urllib.parse import (
+    SplitResult,
+    parse_qs,
+    unquote_plus,
+    urljoin,
+    urlsplit,
+    urlunsplit,
+)
 
-from bs4 import BeautifulSoup
 import requests
+import requests.adapters
 import requests.exceptions
+import urllib3.connection
+import urllib3.connectionpool
+import urllib3.exceptions
+import urllib3.util.connection
 from irc3 import plugin, event
+from irc3.utils import as_list
+from irc3.plugins.command import command
 from isodate import parse_duration
 
 import prawcore
@@ -33,13 +73,6 @@ import praw
 import praw.models
 import praw.exceptions
 
-YOUTUBE_URLS = [
-    "www.youtube.com",
-    "youtube.com",
-    "youtube-nocookie.com",
-    "www.youtube-nocookie.com",
-]
-
 
 def sizeof_fmt(num, suffix="B"):
     """Format printable versions for bytes"""
@@ -65,69 +98,1376 @@ def timedelta_format(duration: datetime.timedelta):
         return "%dm%ds" % (minutes, seconds)
 
 
-def _read_body(response) -> Tuple[int, Optional[str]]:
-    """Count the size of the body of files"""
-    content = StringIO()
-    size = 0
+def _shorten(text: str, width: int = 300) -> str:
+    """Shorten text to at most ``width`` characters on a word boundary
+
+    >>> _shorten("The quick brown fox", 12)
+    'The quick…'
+    """
+    text = " ".join(text.split())
+    if len(text) <= width:
+        return text
+    return text[: width - 1].rsplit(" ", 1)[0] + "…"
+
+
+def _html_text(content: str) -> str:
+    """The text of a fragment of HTML, like that of a Mastodon post
+
+    >>> _html_text("<p>Hello&amp;<br>bye</p><p><a href='#'>#tag</a></p>")
+    'Hello& bye #tag'
+    """
+    content = re.sub(r"<br\s*/?>|</p>", " ", content, flags=re.IGNORECASE)
+    return " ".join(html.unescape(re.sub(r"<[^>]*>", "", content)).split())
+
+
+def _body_size(headers) -> Optional[int]:
+    """Get the size of the complete body from the response headers
+
+    The lengths of compressed responses are the compressed sizes, so they
+    are not the size of the file.
+
+    >>> _body_size({"Content-Range": "bytes 0-0/1234", "Content-Length": "1"})
+    1234
+    >>> _body_size({"Content-Length": "56"})
+    56
+    >>> _body_size({"Content-Range": "bytes 0-0/*"}) is None
+    True
+    >>> _body_size({"Content-Length": "56", "Content-Encoding": "gzip"}) is None
+    True
+    """
+    if headers.get("Content-Encoding", "identity").strip().lower() != "identity":
+        return None
+    content_range = headers.get("Content-Range")
+    if content_range is not None:
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length)
+    return None
+
+
+# We only ask for encodings that zlib can decompress in bounded steps
+ACCEPT_ENCODING = "gzip, deflate"
+
+ZLIB_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "x-gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def _raw_stream(response, chunk_size: int) -> Iterator[bytes]:
+    """Stream the undecoded body, with the exceptions of requests
+
+    ``response.iter_content`` does this translation, reading from
+    ``response.raw`` directly does not.
+    """
+    try:
+        yield from response.raw.stream(chunk_size, decode_content=False)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ReadTimeout(e)
+    except urllib3.exceptions.SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+
+def _iter_decoded(response, chunk_size: int, limit: int) -> Iterator[bytes]:
+    """Iterate over the decoded body, stopping after ``limit`` bytes
+
+    Compressed bodies are decompressed here instead of by urllib3, at most
+    ``chunk_size`` bytes at a time. That way a small compressed response
+    can never expand into more than ``limit`` bytes in memory.
+    Bodies in an encoding we can not decode are not read at all.
+    """
+    encoding = response.headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding == "identity":
+        for chunk in response.iter_content(chunk_size):
+            yield chunk[:limit]
+            limit -= len(chunk)
+            if limit <= 0:
+                return
+        return
+    if encoding not in ZLIB_WBITS:
+        return
+    decompressor = None
+    for data in _raw_stream(response, chunk_size):
+        if decompressor is None:
+            wbits = ZLIB_WBITS[encoding]
+            # Some servers send raw deflate data without the zlib header
+            if encoding == "deflate" and (
+                data[0] & 0x0F != 8 or int.from_bytes(data[:2], "big") % 31
+            ):
+                wbits = -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+        while data:
+            try:
+                chunk = decompressor.decompress(data, min(chunk_size, limit))
+            except zlib.error:
+                return
+            yield chunk
+            limit -= len(chunk)
+            if limit <= 0 or decompressor.eof:
+                return
+            data = decompressor.unconsumed_tail
+
+
+def _read_body(response, budget: int) -> Tuple[int, bytes]:
+    """Read at most ``budget`` bytes of the (decoded) body
+
+    Returns the size of the body, or -1 if it did not fit in the budget or
+    took too long to download, and the bytes that were read.
+    """
+    content = bytearray()
     start_time = time.time()
-    for chunk in response.iter_content(102400):
-        if size < 5 * 1048576:
-            content.write(chunk.decode("utf-8", "ignore"))
-        elif size > 30 * 1048576:
-            response.close()
-            return -1, None
-        if time.time() - start_time > 10:
-            response.close()
-            return -1, None
-        size += len(chunk)
+    for chunk in _iter_decoded(response, 65536, budget + 1):
+        content += chunk
+        if len(content) > budget or time.time() - start_time > 10:
+            del content[budget:]
+            return -1, bytes(content)
+    return len(content), bytes(content)
+
+
+# How much of a media file is read to describe it
+MEDIA_BYTES = 65536
+
+IMAGE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+MP4_TYPES = {
+    "video/mp4",
+    "video/quicktime",
+    "video/x-m4v",
+    "video/3gpp",
+    "audio/mp4",
+    "audio/x-m4a",
+}
+MEDIA_TYPES = IMAGE_TYPES | MP4_TYPES | {"application/pdf"}
+
+
+def _image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Get the dimensions of a PNG, GIF, JPEG or WebP image from its start
+
+    >>> _image_size(b"GIF89a" + struct.pack("<HH", 640, 480))
+    (640, 480)
+    >>> _image_size(b"\\x89PNG\\r\\n\\x1a\\n" + b"\\0\\0\\0\\rIHDR"
+    ...     + struct.pack(">II", 1920, 1080))
+    (1920, 1080)
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        if len(data) >= 24:
+            return struct.unpack(">II", data[16:24])
+    elif data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP" and len(data) >= 25:
+        chunk = data[12:16]
+        if chunk == b"VP8 " and len(data) >= 30:
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X" and len(data) >= 30:
+            return (
+                int.from_bytes(data[24:27], "little") + 1,
+                int.from_bytes(data[27:30], "little") + 1,
+            )
+    elif data.startswith(b"\xff\xd8"):
+        # Walk the JPEG segments until the start of the frame
+        offset = 2
+        while offset + 9 <= len(data) and data[offset] == 0xFF:
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                offset += 2
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+                return width, height
+            else:
+                offset += 2 + int.from_bytes(data[offset + 2 : offset + 4], "big")
+    return None
+
+
+def _mp4_boxes(
+    data: bytes, start: int = 0, end: Optional[int] = None
+) -> Iterator[Tuple[bytes, int, int]]:
+    """Iterate over the (type, payload start, end) of MP4 boxes
+
+    The last box may end after the data.
+    """
+    end = len(data) if end is None else min(end, len(data))
+    offset = start
+    while offset + 8 <= end:
+        size = int.from_bytes(data[offset : offset + 4], "big")
+        kind = data[offset + 4 : offset + 8]
+        header = 8
+        if size == 1 and offset + 16 <= end:
+            size, header = int.from_bytes(data[offset + 8 : offset + 16], "big"), 16
+        elif size == 0:
+            size = 1 << 62
+        if size < header:
+            return
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def _mp4_duration(data: bytes) -> Tuple[Optional[float], Optional[int]]:
+    """Get the duration of an MP4/QuickTime file from its movie header
+
+    ``data`` has to start at the start of a top-level box. If the movie
+    header is not in it, also returns the offset of the next top-level
+    box to read, as the header is often at the end of the file.
+
+    >>> mvhd = struct.pack(">I4sB3x4I", 28, b"mvhd", 0, 0, 0, 1000, 65000)
+    >>> moov = struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd
+    >>> mdat = struct.pack(">I4s", 100000, b"mdat")
+    >>> _mp4_duration(mdat + b"...")
+    (None, 100000)
+    >>> _mp4_duration(moov)
+    (65.0, None)
+    """
+    end = None
+    for kind, start, end in _mp4_boxes(data):
+        if kind != b"moov":
+            continue
+        for child, payload, _child_end in _mp4_boxes(data, start, end):
+            version = data[payload] if payload < len(data) else 0
+            if child != b"mvhd" or payload + (32 if version == 1 else 20) > len(data):
+                continue
+            if version == 1:
+                timescale, duration = struct.unpack(
+                    ">IQ", data[payload + 20 : payload + 32]
+                )
+            else:
+                timescale, duration = struct.unpack(
+                    ">II", data[payload + 12 : payload + 20]
+                )
+            return (duration / timescale if timescale else None), None
+        return None, None
+    if end is not None and end > len(data):
+        return None, end
+    return None, None
+
+
+PDF_LINEARIZED = re.compile(rb"/Linearized\b[^>]*?/N\s+(\d+)")
+PDF_PAGES = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)")
+PDF_TITLE = re.compile(rb"/Title\s*(?:\(((?:[^()\\]|\\.)*)\)|<([0-9A-Fa-f\s]*)>)")
+
 
-    return size, content.getvalue()
+def _pdf_string(value: bytes) -> str:
+    """Decode a PDF text string"""
+    if value.startswith(codecs.BOM_UTF16_BE):
+        return value[2:].decode("utf-16-be", "replace")
+    return value.decode("latin-1")
+
+
+def _pdf_info(data: bytes) -> Tuple[Optional[int], Optional[str]]:
+    """Get the number of pages and the title from the start of a PDF
+
+    Best effort: these are only found if they are near the start of the
+    file, like in linearized ("fast web view") PDFs.
+
+    >>> _pdf_info(b"%PDF-1.4 1 0 obj <</Linearized 1/L 1234/N 12>> endobj "
+    ...     b"2 0 obj <</Title (A \\\\(small\\\\) test)>>")
+    (12, 'A (small) test')
+    >>> _pdf_info(b"%PDF-1.4 1 0 obj <</Title <4869 7>>>")
+    (None, 'Hip')
+    """
+    if not data.startswith(b"%PDF-"):
+        return None, None
+    match = PDF_LINEARIZED.search(data)
+    if match is not None:
+        pages: Optional[int] = int(match.group(1))
+    else:
+        pages = max((int(m.group(1)) for m in PDF_PAGES.finditer(data)), default=None)
+    title = None
+    match = PDF_TITLE.search(data)
+    if match is not None and match.group(1) is not None:
+        value = re.sub(rb"\\(.)", rb"\1", match.group(1))
+        title = _pdf_string(value).strip() or None
+    elif match is not None:
+        hexstring = re.sub(rb"\s", b"", match.group(2)).decode("ascii")
+        if len(hexstring) % 2:
+            # A missing last digit is taken to be 0
+            hexstring += "0"
+        title = _pdf_string(bytes.fromhex(hexstring)).strip() or None
+    return pages, title
+
+
+class HeadParser(HTMLParser):
+    """Parser that collects metadata from the document head
+
+    Everything after :attr:`done` is set is ignored: that is at ``</head>``
+    or the start of the body.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title: Optional[str] = None
+        self.meta: Dict[str, str] = {}
+        self.oembed: Optional[str] = None
+        self.done = False
+        self._title_parts: Optional[List[str]] = None
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]):
+        if self.done:
+            return
+        if tag == "title" and self.title is None:
+            self._title_parts = []
+        elif tag == "meta":
+            attributes = dict(attrs)
+            key = attributes.get("property") or attributes.get("name")
+            content = attributes.get("content")
+            if key and content:
+                self.meta.setdefault(key.lower(), content)
+        elif tag == "link":
+            attributes = dict(attrs)
+            rel = (attributes.get("rel") or "").lower().split()
+            type_ = (attributes.get("type") or "").lower()
+            if "alternate" in rel and type_ == "application/json+oembed":
+                self.oembed = self.oembed or attributes.get("href")
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag: str):
+        if self.done:
+            return
+        if tag == "title" and self._title_parts is not None:
+            self.title = "".join(self._title_parts)
+            self._title_parts = None
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data: str):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+
+# How much of the document is searched for a <meta charset>
+SNIFF_BYTES = 2048
+
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# Codecs that browsers decode as a superset of what the label says
+CHARSET_ALIASES = {
+    "iso8859-1": "cp1252",
+    "ascii": "cp1252",
+    "gb2312": "gbk",
+    "shift_jis": "cp932",
+}
+
+# Labels that browsers know, but Python does not
+CHARSET_LABELS = {
+    "x-sjis": "shift_jis",
+    "windows-31j": "cp932",
+}
+
+CHARSET_PARAMETER = re.compile(rb"""charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+META_CHARSET = re.compile(
+    rb"""<meta\s[^>]*?charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE
+)
+
+
+def _codec(label: Optional[str]) -> Optional[str]:
+    """Find the Python codec for a charset label
+
+    >>> _codec("ISO_8859-1"), _codec("l1"), _codec("US-ASCII")
+    ('cp1252', 'cp1252', 'cp1252')
+    >>> _codec("x-sjis"), _codec("euc-cn"), _codec("klingon")
+    ('cp932', 'gbk', None)
+    """
+    if not label:
+        return None
+    label = label.strip().lower()
+    try:
+        name = codecs.lookup(CHARSET_LABELS.get(label, label)).name
+    except LookupError:
+        return None
+    return CHARSET_ALIASES.get(name, name)
+
+
+def _declared_charset(content_type: Optional[str], start: bytes) -> Optional[str]:
+    """Find the charset a document declares in its first bytes
+
+    In order, checks the byte order mark, the Content-Type header and a
+    ``<meta charset>`` in the first :data:`SNIFF_BYTES` bytes, like a
+    browser does.
+
+    >>> _declared_charset("text/html; charset=Shift_JIS", b"<html>")
+    'cp932'
+    >>> _declared_charset("text/html", b'<meta http-equiv="Content-Type" '
+    ...     b'content="text/html; charset=iso-8859-1">')
+    'cp1252'
+    >>> _declared_charset("text/html; charset=gbk", codecs.BOM_UTF8 + b"<html>")
+    'utf-8-sig'
+    >>> _declared_charset(None, b"<meta charset=bogus>") is None
+    True
+    """
+    for bom, codec in BOMS:
+        if start.startswith(bom):
+            return codec
+    if content_type:
+        match = CHARSET_PARAMETER.search(content_type.encode("latin-1", "ignore"))
+        codec = match and _codec(match.group(1).decode("ascii"))
+        if codec:
+            return codec
+    match = META_CHARSET.search(start[:SNIFF_BYTES])
+    codec = match and _codec(match.group(1).decode("ascii"))
+    # A document that could declare its charset in ascii is not utf-16
+    if codec and not codec.startswith("utf-16"):
+        return codec
+    return None
+
+
+class HeadInfo(NamedTuple):
+    """What was found in the head of a document"""
+
+    title: Optional[str]
+    meta: Dict[str, str]
+    #: Where the oEmbed data of the document is, may be relative
+    oembed: Optional[str] = None
+
+
+def _parse_head(content: bytes, content_type: Optional[str]) -> HeadInfo:
+    """Decode and parse the start of a document
+
+    The charset is determined from the first :data:`SNIFF_BYTES` bytes
+    (see :func:`_declared_charset`), utf-8 is assumed if none is declared.
+    This is CPU-bound work, so it can be run in another process.
+    """
+    parser = HeadParser()
+    charset = _declared_charset(content_type, content[:SNIFF_BYTES]) or "utf-8"
+    parser.feed(content.decode(charset, "replace"))
+    return HeadInfo(parser.title, parser.meta, parser.oembed)
+
+
+def _head_markers(start: bytes) -> List[bytes]:
+    """The (lowercase) tags after which we have read enough of a document
+
+    The last one is the end of a tag.
+    """
+    markers = ["</head", "<body"]
+    encoding = "ascii"
+    if start.startswith(codecs.BOM_UTF16_LE):
+        encoding = "utf-16-le"
+    elif start.startswith(codecs.BOM_UTF16_BE):
+        encoding = "utf-16-be"
+    return [marker.encode(encoding) for marker in markers + [">"]]
+
+
+def _read_head_bytes(response, budget: int = 2 * 1048576) -> bytes:
+    """Download the start of a document, up to the end of its head
+
+    Only looks for the closing tags in the raw bytes, so reading stays
+    cheap and usually only the first few KiB of a page are transferred.
+    The ``budget`` counts decoded bytes.
+    """
+    chunks: List[bytes] = []
+    markers: List[bytes] = []
+    end_of_tag = b">"
+    found = -1
+    tail = b""
+    read = 0
+    start_time = time.time()
+    for chunk in _iter_decoded(response, 16384, budget):
+        if not markers:
+            *markers, end_of_tag = _head_markers(chunk)
+        chunks.append(chunk)
+        read += len(chunk)
+        # Markers may be split over two chunks
+        window = (tail + chunk).lower()
+        if found < 0:
+            found = min(
+                (window.find(marker) for marker in markers if marker in window),
+                default=-1,
+            )
+        # Also read the end of the tag, or the parser will not see it
+        if (
+            (found >= 0 and window.find(end_of_tag, found) >= 0)
+            or read >= budget
+            or time.time() - start_time > 10
+        ):
+            break
+        if found >= 0:
+            found, tail = 0, b""
+        else:
+            tail = chunk[-16:]
+    return b"".join(chunks)
 
 
 URL_PATTERN = re.compile(r"\bhttps?://\S+")
 
+BRACKETS = {")": "(", "]": "[", "}": "{", ">": "<"}
+
+
+def _strip_url(url: str) -> str:
+    """Strip trailing punctuation and unbalanced closing brackets
+
+    >>> _strip_url("https://nos.nl/(test)test),")
+    'https://nos.nl/(test)test'
+    """
+    # Count the brackets once, then strip from the end while updating them
+    balance = {rbr: url.count(rbr) - url.count(lbr) for rbr, lbr in BRACKETS.items()}
+    end = len(url)
+    while end > 0:
+        char = url[end - 1]
+        if char in ".,'\"":
+            end -= 1
+        elif char in balance and balance[char] > 0:
+            balance[char] -= 1
+            end -= 1
+        else:
+            break
+    return url[:end]
+
 
-def _find_urls(string) -> List[str]:
+def _find_urls(string: str) -> List[str]:
     """Find all urls in a string"""
-    urls = []
-    for match in URL_PATTERN.finditer(string):
-        url = match.group(0).rstrip(".,'\"")
-        # Find matching pairs, strip others
-        for lbr, rbr in [("(", ")"), ("[", "]"), ("{", "}"), ("<", ">")]:
-            rest = url
-            count = 0
-            # FIXME this is still really hacky
-            for char in reversed(url):
-                # ends with rb
-                if char == rbr:
-                    # find lbr and what follows
-                    split = rest.split(lbr, maxsplit=1)
-                    if len(split) < 2:
-                        count += 1
-                    else:
-                        rest = split[1]
-                        if rbr in rest.rstrip(rbr):
-                            count += 1
-                else:
-                    break
-            if count > 0:
-                url = url[:-count]
-        urls.append(url)
-    return urls
+    if "://" not in string:
+        return []
+    return [_strip_url(match.group(0)) for match in URL_PATTERN.finditer(string)]
+
+
+# Query parameters that only track where a link was shared. Names ending in
+# ``*`` are prefixes, ``name=value`` only matches that value.
+TRACKING_PARAMETERS = [
+    "utm_*",
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "mc_cid",
+    "mc_eid",
+    "igshid",
+    "si",
+    "ref_src",
+    "feature=share",
+]
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class UrlCanonicalizer(object):
+    """Rewrite urls to a canonical form
+
+    Tracking parameters and the fragment are removed, the scheme and host
+    are lowercased, default ports are dropped and the query parameters are
+    sorted. Parameters are compared unquoted but otherwise kept as they
+    were written, so the url still points to the same resource.
+
+    >>> canonicalize = UrlCanonicalizer()
+    >>> canonicalize("HTTPS://Example.COM:443/a?b=1&utm_source=x&a=2#top")
+    'https://example.com/a?a=2&b=1'
+    >>> canonicalize("https://youtu.be/abc?si=XYZ&feature=share&t=3")
+    'https://youtu.be/abc?t=3'
+    """
+
+    def __init__(
+        self,
+        strip_parameters: Iterable[str] = TRACKING_PARAMETERS,
+        sort_query: bool = True,
+        strip_trailing_slash: bool = False,
+    ):
+        self.sort_query = sort_query
+        self.strip_trailing_slash = strip_trailing_slash
+        self._names: Set[str] = set()
+        self._prefixes: List[str] = []
+        self._pairs: Set[Tuple[str, str]] = set()
+        for parameter in strip_parameters:
+            if parameter.endswith("*"):
+                self._prefixes.append(parameter[:-1])
+            elif "=" in parameter:
+                name, _, value = parameter.partition("=")
+                self._pairs.add((name, value))
+            else:
+                self._names.add(parameter)
+
+    def _is_tracking(self, parameter: str) -> bool:
+        name, _, value = parameter.partition("=")
+        name, value = unquote_plus(name), unquote_plus(value)
+        return (
+            name in self._names
+            or (name, value) in self._pairs
+            or any(name.startswith(prefix) for prefix in self._prefixes)
+        )
+
+    def __call__(self, url: str) -> str:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").rstrip(".")
+        if ":" in host:
+            host = f"[{host}]"
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        netloc = host
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            netloc = f"{host}:{port}"
+        if parts.username is not None:
+            userinfo = parts.netloc.rpartition("@")[0]
+            netloc = f"{userinfo}@{netloc}"
+        path = parts.path or "/"
+        if self.strip_trailing_slash and len(path) > 1:
+            path = path.rstrip("/") or "/"
+        parameters = [
+            parameter
+            for parameter in parts.query.split("&")
+            if parameter and not self._is_tracking(parameter)
+        ]
+        if self.sort_query:
+            parameters.sort(key=lambda parameter: parameter.partition("=")[0])
+        return urlunsplit((scheme, netloc, path, "&".join(parameters), ""))
+
+
+class Validators(NamedTuple):
+    """What a server needs to tell if a cached response is still current"""
+
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    @classmethod
+    def from_headers(cls, headers) -> Optional["Validators"]:
+        """Get the validators of a response, if it has any
+
+        >>> Validators.from_headers({"ETag": '"abc"'})
+        Validators(etag='"abc"', last_modified=None)
+        >>> Validators.from_headers({}) is None
+        True
+        """
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return None
+        return cls(etag, last_modified)
+
+    def request_headers(self) -> Dict[str, str]:
+        """Headers that make the request conditional"""
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Revalidation(object):
+    """Validators of a cached result, and what the server said about them
+
+    Passed to the processors, which may send the validators along and set
+    :attr:`not_modified` if the cached result is still current. They set
+    :attr:`validators` to those of the response they got.
+    """
+
+    def __init__(self, validators: Optional[Validators] = None):
+        self.validators = validators
+        self.not_modified = False
+
+
+class CacheEntry(NamedTuple):
+    expires: float
+    value: list[str]
+    ttl: int
+    validators: Optional[Validators]
+    #: Until when the entry may be used while it is being refreshed
+    stale_until: float
+
+
+class UrlCache(object):
+    """Thread-safe LRU cache of url lookup results with a time to live
+
+    Entries that are stored with a ``stale_ttl`` are kept for that much
+    longer after they expire, see :meth:`get_stale`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl: int = 3600,
+        error_ttl: int = 60,
+        stale_ttl: int = 0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, key: str, now: float) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.stale_until < now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key: str) -> Optional[list[str]]:
+        """Get the cached result, or None if it's not (or no longer) cached"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entry(key, now)
+            if entry is None or entry.expires < now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def get_stale(self, key: str) -> Optional[CacheEntry]:
+        """Get an expired entry that may still be used while it is refreshed"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entry(key, now)
+            if entry is None or entry.expires >= now:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(
+        self,
+        key: str,
+        value: list[str],
+        ttl: Optional[int] = None,
+        validators: Optional[Validators] = None,
+        stale_ttl: Optional[int] = None,
+    ) -> None:
+        """Store a result, evicting the least recently used entries"""
+        if ttl is None:
+            ttl = self.ttl
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+        with self._lock:
+            expires = time.monotonic() + ttl
+            self._entries[key] = CacheEntry(
+                expires, value, ttl, validators, expires + stale_ttl
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def postpone(self, key: str, entry: CacheEntry, delay: int) -> None:
+        """Keep using an expired entry for another ``delay`` seconds"""
+        with self._lock:
+            expires = time.monotonic() + delay
+            self._entries[key] = entry._replace(
+                expires=expires, stale_until=max(entry.stale_until, expires)
+            )
+            self._entries.move_to_end(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> str:
+        return "Cache: {} entries, {} hits, {} misses, {} evictions".format(
+            len(self), self.hits, self.misses, self.evictions
+        )
+
+
+class PersistentUrlCache(object):
+    """SQLite-backed cache of url lookup results that survives restarts
+
+    The database is only opened on first use and entries are read one at a
+    time, so loading the plugin does not read the whole file.
+    """
+
+    def __init__(self, filename: str, max_entries: int = 10000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls (key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS urls_accessed ON urls (accessed)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[list[str], float]]:
+        """Get the cached result and its remaining time to live"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires FROM urls WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                return None
+            with conn:
+                conn.execute("UPDATE urls SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), row[1] - now
+
+    def put(self, key: str, value: list[str], ttl: int) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now + ttl, now),
+                )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._compact(conn)
+
+    def compact(self) -> None:
+        """Drop expired entries and the least recently used ones over the limit"""
+        with self._lock:
+            self._compact(self._connect())
+
+    def _compact(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            conn.execute("DELETE FROM urls WHERE expires < ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM urls WHERE key IN (SELECT key FROM urls "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_public_address(address: str) -> bool:
+    """Check if an address may be visited
+
+    >>> _is_public_address("10.0.0.1")
+    False
+    >>> _is_public_address("1.1.1.1")
+    True
+    """
+    ip = ipaddress.ip_address(address)
+    return not (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved)
+
+
+class HostResolver(object):
+    """Resolve hostnames with a cache
+
+    ``getaddrinfo`` does not tell us the TTL of the records, so resolved
+    addresses are kept for a fixed time. Concurrent lookups of the same
+    hostname wait for the first one instead of resolving it again.
+    """
+
+    def __init__(self, ttl: int = 300, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.lookups = 0
+        self._cache: OrderedDict[str, Tuple[float, List[str]]] = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, hostname: str) -> List[str]:
+        """Get the addresses of a hostname, may raise socket.gaierror"""
+        with self._lock:
+            entry = self._cache.get(hostname)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(hostname)
+                self.hits += 1
+                return entry[1]
+            future = self._pending.get(hostname)
+            leader = future is None
+            if leader:
+                future = self._pending[hostname] = Future()
+        if not leader:
+            self.hits += 1
+            return future.result()
+
+        try:
+            self.lookups += 1
+            addresses = list(
+                dict.fromkeys(
+                    sockaddr[0]
+                    for _f, _t, _p, _c, sockaddr in socket.getaddrinfo(hostname, None)
+                )
+            )
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(addresses)
+            with self._lock:
+                self._cache[hostname] = (time.monotonic() + self.ttl, addresses)
+                self._cache.move_to_end(hostname)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            return addresses
+        finally:
+            with self._lock:
+                del self._pending[hostname]
+
+    def stats(self) -> str:
+        return "DNS: {} lookups, {} cached".format(self.lookups, self.hits)
+
+
+class _VettedConnectionMixin(object):
+    """Open the socket to an address vetted by the resolver
+
+    The connection keeps its hostname, so the Host header, SNI and the
+    certificate check are unaffected. Only the resolution is replaced.
+    """
+
+    resolver: HostResolver
+
+    def _new_conn(self) -> socket.socket:
+        try:
+            addresses = self.resolver.resolve(self._dns_host)
+        except socket.gaierror as e:
+            raise urllib3.exceptions.NameResolutionError(self.host, self, e) from e
+        if not all(_is_public_address(address) for address in addresses):
+            raise urllib3.exceptions.NewConnectionError(
+                self, f"Refusing to connect to non-public address of {self.host}"
+            )
+        error: Optional[OSError] = None
+        for address in addresses:
+            try:
+                return urllib3.util.connection.create_connection(
+                    (address, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout as e:
+                raise urllib3.exceptions.ConnectTimeoutError(
+                    self,
+                    f"Connection to {self.host} timed out. "
+                    f"(connect timeout={self.timeout})",
+                ) from e
+            except OSError as e:
+                error = e
+        raise urllib3.exceptions.NewConnectionError(
+            self, f"Failed to establish a new connection: {error}"
+        )
+
+
+class _BoundedPoolMixin(object):
+    """Wait at most ``pool_timeout`` seconds for a free connection
+
+    requests never passes a timeout for the pool, so with ``pool_block``
+    a request would otherwise wait forever while all connections are used.
+    """
+
+    pool_timeout: Optional[float]
+
+    def _get_conn(self, timeout: Optional[float] = None):
+        return super()._get_conn(self.pool_timeout if timeout is None else timeout)
+
+
+class VettedAddressAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that only connects to addresses vetted by a resolver
+
+    Because the addresses come from the same cache that the private address
+    filter used, each fetch resolves its hostname once and the check holds
+    for the connection that is actually made.
+    """
+
+    def __init__(
+        self, resolver: HostResolver, pool_timeout: Optional[float] = None, **kwargs
+    ):
+        self.resolver = resolver
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, *args, **kwargs) -> requests.Response:
+        try:
+            return super().send(request, *args, **kwargs)
+        except urllib3.exceptions.EmptyPoolError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        pool_classes = {}
+        for scheme, pool_cls in (
+            ("http", urllib3.connectionpool.HTTPConnectionPool),
+            ("https", urllib3.connectionpool.HTTPSConnectionPool),
+        ):
+            connection_cls = type(
+                "Vetted" + pool_cls.ConnectionCls.__name__,
+                (_VettedConnectionMixin, pool_cls.ConnectionCls),
+                {"resolver": self.resolver},
+            )
+            pool_classes[scheme] = type(
+                "Vetted" + pool_cls.__name__,
+                (_BoundedPoolMixin, pool_cls),
+                {"ConnectionCls": connection_cls, "pool_timeout": self.pool_timeout},
+            )
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+
+UrlProcessor = Callable[..., Optional[list[str]]]
+
+
+class _HostNode(object):
+    __slots__ = ("children", "exact", "domain")
+
+    def __init__(self):
+        self.children: Dict[str, _HostNode] = {}
+        self.exact: List[UrlProcessor] = []
+        self.domain: List[UrlProcessor] = []
+
+
+class HostIndex(object):
+    """Index of url processors by hostname
+
+    Processors are registered for exact hostnames or for domains, which also
+    match all subdomains. They are kept in a trie of reversed labels, so
+    finding the processors for a hostname takes one step per label.
+    """
+
+    def __init__(self):
+        self._root = _HostNode()
+
+    def _node(self, hostname: str) -> _HostNode:
+        node = self._root
+        for label in reversed(hostname.lower().rstrip(".").split(".")):
+            node = node.children.setdefault(label, _HostNode())
+        return node
+
+    def add(
+        self,
+        processor: UrlProcessor,
+        hosts: Iterable[str] = (),
+        domains: Iterable[str] = (),
+    ) -> None:
+        for host in hosts:
+            self._node(host).exact.append(processor)
+        for domain in domains:
+            self._node(domain).domain.append(processor)
+
+    def lookup(self, hostname: str) -> Set[UrlProcessor]:
+        """Get the processors registered for a hostname"""
+        result: Set[UrlProcessor] = set()
+        node = self._root
+        for label in reversed(hostname.lower().rstrip(".").split(".")):
+            next_node = node.children.get(label)
+            if next_node is None:
+                return result
+            node = next_node
+            result.update(node.domain)
+        result.update(node.exact)
+        return result
+
+
+class BatchLookup(object):
+    """Combine concurrent lookups of single keys into batched calls
+
+    The first caller waits ``window`` seconds for others to join, then
+    fetches all waiting keys with calls of at most ``max_batch`` keys each.
+    ``fetch`` gets a list of keys and returns a dict of results. Results are
+    cached per key.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[List[str]], Dict[str, list[str]]],
+        cache: UrlCache,
+        window: float = 0.05,
+        max_batch: int = 50,
+    ):
+        self.fetch = fetch
+        self.cache = cache
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self._pending: Dict[str, Future] = {}
+        self._waiting: List[str] = []
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list[str]]:
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        leader = False
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                self._waiting.append(key)
+                leader = len(self._waiting) == 1
+        if leader:
+            time.sleep(self.window)
+            self._flush()
+        return future.result(timeout=30)
+
+    def _flush(self) -> None:
+        with self._lock:
+            keys, self._waiting = self._waiting, []
+        for i in range(0, len(keys), self.max_batch):
+            batch = keys[i : i + self.max_batch]
+            self.batches += 1
+            error: Optional[Exception] = None
+            try:
+                results = self.fetch(batch)
+            except Exception as e:
+                results, error = {}, e
+            with self._lock:
+                futures = [self._pending.pop(key) for key in batch]
+            for key, future in zip(batch, futures):
+                if error is not None:
+                    future.set_exception(error)
+                    continue
+                result = results.get(key)
+                if result is not None:
+                    self.cache.put(key, result)
+                future.set_result(result)
+
+
+class LookupQueue(object):
+    """Bounded queue of url lookups that is served fairly
+
+    Waiting lookups are grouped per channel and then per nick, and both are
+    served round-robin, so a single busy channel or nick cannot starve the
+    others. At most ``concurrency`` lookups run at the same time. When more
+    than ``capacity`` lookups are waiting, the oldest lookup of the nick
+    with the most waiting lookups is dropped; it resolves to ``None``.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[str], Awaitable[Optional[list[str]]]],
+        concurrency: int = 4,
+        capacity: int = 64,
+    ):
+        self.run = run
+        self.concurrency = concurrency
+        self.capacity = capacity
+        self.running = 0
+        self.waiting = 0
+        self.dropped = 0
+        self._channels: OrderedDict[
+            str, OrderedDict[str, Deque[Tuple[str, asyncio.Future]]]
+        ] = OrderedDict()
+
+    def submit(self, channel: str, nick: str, url: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        nicks = self._channels.setdefault(channel, OrderedDict())
+        nicks.setdefault(nick, deque()).append((url, future))
+        self.waiting += 1
+        if self.waiting > self.capacity:
+            self._drop()
+        self._dispatch()
+        return future
+
+    def _drop(self) -> None:
+        channel, nick = max(
+            (
+                (channel, nick)
+                for channel, nicks in self._channels.items()
+                for nick in nicks
+            ),
+            key=lambda key: len(self._channels[key[0]][key[1]]),
+        )
+        _url, future = self._pop(channel, nick)
+        self.dropped += 1
+        if not future.cancelled():
+            future.set_result(None)
+
+    def _pop(self, channel: str, nick: str) -> Tuple[str, asyncio.Future]:
+        nicks = self._channels[channel]
+        item = nicks[nick].popleft()
+        self.waiting -= 1
+        if not nicks[nick]:
+            del nicks[nick]
+        if not nicks:
+            del self._channels[channel]
+        return item
+
+    def _dispatch(self) -> None:
+        while self.running < self.concurrency and self._channels:
+            # Take the first channel and nick in line and move them to the back
+            channel, nicks = next(iter(self._channels.items()))
+            nick = next(iter(nicks))
+            self._channels.move_to_end(channel)
+            nicks.move_to_end(nick)
+            url, future = self._pop(channel, nick)
+            if future.cancelled():
+                continue
+            self.running += 1
+            asyncio.ensure_future(self._run(url, future))
+
+    async def _run(self, url: str, future: asyncio.Future) -> None:
+        try:
+            result = await self.run(url)
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+    def stats(self) -> str:
+        return "Queue: {} waiting, {} running, {} dropped".format(
+            self.waiting, self.running, self.dropped
+        )
+
+
+class _HostState(object):
+    __slots__ = ("failures", "opened_at", "probing", "last_error", "latency")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.last_error = ""
+        self.latency: Optional[float] = None
+
+
+class HostBreakers(object):
+    """Circuit breakers for slow or failing hosts
+
+    After ``threshold`` consecutive failures the breaker of a host opens and
+    requests to it fail fast for ``cooldown`` seconds. After that a single
+    request is let through as a probe: if it succeeds the breaker closes,
+    if it fails the breaker opens again.
+    """
+
+    def __init__(self, threshold: int = 3, cooldown: int = 300, max_hosts: int = 1024):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_hosts = max_hosts
+        self._hosts: OrderedDict[str, _HostState] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, host: str) -> _HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState()
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        self._hosts.move_to_end(host)
+        return state
+
+    def allow(self, host: str) -> bool:
+        """Check if a request to this host may be made"""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state.opened_at is None:
+                return True
+            if state.probing or time.monotonic() < state.opened_at + self.cooldown:
+                return False
+            state.probing = True
+            return True
+
+    def last_error(self, host: str) -> str:
+        with self._lock:
+            state = self._hosts.get(host)
+            return state.last_error if state is not None else ""
+
+    def success(self, host: str, latency: float) -> None:
+        with self._lock:
+            state = self._state(host)
+            state.failures = 0
+            state.opened_at = None
+            state.probing = False
+            self._record_latency(state, latency)
+
+    def failure(self, host: str, error: str, latency: float) -> None:
+        with self._lock:
+            state = self._state(host)
+            state.failures += 1
+            state.last_error = error
+            state.probing = False
+            self._record_latency(state, latency)
+            if state.failures >= self.threshold:
+                state.opened_at = time.monotonic()
+
+    @staticmethod
+    def _record_latency(state: _HostState, latency: float) -> None:
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency = 0.8 * state.latency + 0.2 * latency
+
+    def stats(self) -> str:
+        with self._lock:
+            broken = [
+                "{} {} ({} failures, {:.1f}s)".format(
+                    host,
+                    "probing" if state.probing else "open",
+                    state.failures,
+                    state.latency or 0,
+                )
+                for host, state in self._hosts.items()
+                if state.opened_at is not None
+            ]
+        if not broken:
+            return "Breakers: all closed"
+        return "Breakers: {}".format(", ".join(broken))
 
 
 class UrlSkipException(Exception):
     pass
 
 
+class UrlErrorException(Exception):
+    """The lookup failed, the message is shown instead of the url info
+
+    Without a message nothing is shown. Either way, the failure is only
+    remembered for ``cache_error_ttl`` seconds.
+    """
+
+    def __init__(self, message: Optional[str] = None):
+        super().__init__(message)
+        self.message = message
+
+
 class UrlRedirectException(Exception):
-    def __init__(self, next: str):
+    def __init__(self, next: str, status: Optional[int] = None):
         super().__init__()
         self.next = next
+        #: HTTP status code, if this redirect was sent by the site
+        self.status = status
 
 
 REDDIT_USER_PATTERN = re.compile(r"^/u(?:ser)?/(?P<user>[^/]+)/?$")
 
+# How long results of the site-specific processors stay valid
+PROCESSOR_TTLS = {
+    "youtube": 3 * 86400,
+    "reddit": 86400,
+    "twitter": 7 * 86400,
+    "oembed": 86400,
+    "wikipedia": 86400,
+    "github": 3600,
+    "mastodon": 3600,
+}
+
+# Domains that only exist on local networks
+LOCAL_DOMAINS = (".local", ".localdomain", ".internal", ".lan", ".home.arpa")
+
+MASTODON_STATUS_PATTERN = re.compile(r"^/@[\w.]+(@[\w.-]+)?/(?P<id>\d+)/?$")
+
+# Keys that irc3's parse_config adds to every section
+IRC3_CONFIG_DEFAULTS = ("hash", "#", "##")
+
+# Sites with an oEmbed endpoint, these are asked instead of loading the page
+OEMBED_ENDPOINTS = {
+    "open.spotify.com": "https://open.spotify.com/oembed",
+    "soundcloud.com": "https://soundcloud.com/oembed",
+    "vimeo.com": "https://vimeo.com/api/oembed.json",
+    "mixcloud.com": "https://app.mixcloud.com/oembed/",
+}
+
 # User agent for PRAW
 USER_AGENT_STRING = "OneBot by /u/DutchDudeWCD"
 
@@ -139,18 +1479,74 @@ class UrlInfo(object):
     Configuration settings:
         - ``cookiejar``: Cookies to identify to sites with
         - ``ignored_classes``: ignored MIME classes
-        - ``ignored_apps``: ignored ``application/`` classes
+        - ``ignored_apps``: ignored ``application/`` classes, images, videos
+          and PDFs are still shown if their start could be described
         - ``ignored_channels``: channels to not post information in
         - ``ignored_nicks``: whom to ignore
         - ``youtube_api_key``: key for the YouTube API
+        - ``github_token``: token for the GitHub API, for higher rate limits
+        - ``workers``: number of urls that are looked up at the same time
+        - ``reply_deadline``: seconds after which the urls that are done
+          are sent, slower urls get their own line later
+        - ``reply_timeout``: seconds after which slow urls are dropped
+        - ``queue_size``: number of urls that may wait to be looked up,
+          more are dropped
+        - ``connections_per_host``: size of the connection pool per host
+        - ``pool_timeout``: seconds to wait for a free connection to a host
+        - ``cache_size``: number of results kept in memory
+        - ``cache_ttl``: seconds to keep results
+        - ``cache_error_ttl``: seconds to remember failed lookups
+        - ``cache_stale_ttl``: seconds an expired result is still sent,
+          while it is refreshed in the background
+        - ``cache_file``: SQLite file to keep results in across restarts
+        - ``cache_file_size``: number of results kept in ``cache_file``
+        - ``dns_ttl``: seconds to remember resolved hostnames
+        - ``redirect_ttl``: seconds to remember where permanent redirects go
+        - ``temporary_redirect_ttl``: same, for temporary redirects
+        - ``breaker_threshold``: failed requests after which a host is
+          left alone for ``breaker_cooldown`` seconds
+        - ``reddit_timeout``: seconds a Reddit lookup may take
+        - ``youtube_batch_window``: seconds to wait for more videos to look
+          up in the same YouTube API call
+        - ``parse_workers``: number of processes that parse large pages
+        - ``parse_inline_bytes``: pages up to this size are parsed in the
+          lookup thread, sending them to another process costs more
+        - ``parse_timeout``: seconds the parsing of a page may take
+        - ``parse_worker_tasks``: pages a parser process handles before it
+          is replaced
 
     **URL Map**
 
     Using the section ``[onebot.plugins.urlinfo.urlmap]`` it's possible
     to automatically translate urls. Set them as from=to. It's a dumb
     find-and-replace.
+
+    **Canonical urls**
+
+    Before anything else, urls are rewritten to a canonical form that is
+    also used as the key of the caches. ``strip_parameters`` lists the query
+    parameters to remove (default: common tracking parameters, see
+    :data:`TRACKING_PARAMETERS`), ``sort_query`` (default true) sorts the
+    remaining parameters and ``strip_trailing_slash`` (default false)
+    removes trailing slashes from paths.
+
+    **oEmbed**
+
+    Urls of sites in :data:`OEMBED_ENDPOINTS` are described from their
+    oEmbed data instead of their page. More sites can be added in the
+    section ``[onebot.plugins.urlinfo.oembed]`` as domain=endpoint.
+
+    **Cache TTLs**
+
+    The section ``[onebot.plugins.urlinfo.cache_ttl]`` overrides how many
+    seconds results of each processor are kept, e.g. ``youtube=259200``
+    or ``default=14400``. Processors without a setting use ``cache_ttl``.
     """
 
+    requires = [
+        "irc3.plugins.command",
+    ]
+
     def __init__(self, bot):
         """Init"""
         self.bot = bot
@@ -164,6 +1560,7 @@ class UrlInfo(object):
         self.ignored_channels: list[str] = self.config.get("ignored_channels", [])
         self.ignored_nicks: list[str] = self.config.get("ignored_nicks", [])
         self.youtube_api_key: Optional[str] = self.config.get("youtube_api_key")
+        self.github_token: Optional[str] = self.config.get("github_token")
         reddit_client_id: Optional[str] = self.config.get("reddit_client_id")
         reddit_client_secret: Optional[str] = self.config.get("reddit_client_secret")
         self.cookiejar = None
@@ -173,283 +1570,982 @@ class UrlInfo(object):
 
         self.urlmap = self.bot.config.get(__name__ + ".urlmap", {})
 
+        self.reddit_timeout = int(self.config.get("reddit_timeout", 8))
         self.praw = None
         if "praw_client_id" in os.environ and "praw_client_secret" in os.environ:
-            self.praw = praw.Reddit(user_agent=USER_AGENT_STRING, check_for_async=False)
+            self.praw = praw.Reddit(
+                user_agent=USER_AGENT_STRING,
+                check_for_async=False,
+                timeout=self.reddit_timeout,
+            )
         if reddit_client_id is not None and reddit_client_secret is not None:
             self.praw = praw.Reddit(
                 client_id=reddit_client_id,
                 client_secret=reddit_client_secret,
                 user_agent=USER_AGENT_STRING,
                 check_for_async=False,
+                timeout=self.reddit_timeout,
             )
 
+        self.canonicalize = UrlCanonicalizer(
+            strip_parameters=as_list(
+                self.config.get("strip_parameters", TRACKING_PARAMETERS)
+            ),
+            sort_query=self.config.get("sort_query", True),
+            strip_trailing_slash=self.config.get("strip_trailing_slash", False),
+        )
+
+        self.redirect_ttl = int(self.config.get("redirect_ttl", 86400))
+        self.temporary_redirect_ttl = int(
+            self.config.get("temporary_redirect_ttl", 600)
+        )
+        self.redirect_cache = UrlCache(max_entries=2048, ttl=self.redirect_ttl)
+
+        self.resolver = HostResolver(ttl=int(self.config.get("dns_ttl", 300)))
+
+        # One pooled session for all lookups, so connections are kept alive
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "User-Agent": "script:onebot:irc",
+                "Accept-Language": "en-GB, en-US, en, nl-NL, nl",
+                "Accept-Encoding": ACCEPT_ENCODING,
+            }
+        )
+        if self.cookiejar:
+            self.session.cookies = self.cookiejar
+        adapter = VettedAddressAdapter(
+            self.resolver,
+            pool_connections=32,
+            pool_maxsize=int(self.config.get("connections_per_host", 4)),
+            pool_block=True,
+            pool_timeout=float(self.config.get("pool_timeout", 5)),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.cache = UrlCache(
+            max_entries=int(self.config.get("cache_size", 512)),
+            ttl=int(self.config.get("cache_ttl", 3600)),
+            error_ttl=int(self.config.get("cache_error_ttl", 60)),
+            stale_ttl=int(self.config.get("cache_stale_ttl", 86400)),
+        )
+        self._refreshing: Set[str] = set()
+        self._refreshing_lock = threading.Lock()
+
+        self.processor_ttls = dict(PROCESSOR_TTLS)
+        for name, ttl in self.bot.config.get(__name__ + ".cache_ttl", {}).items():
+            # irc3 adds some default keys to every section, skip those
+            if hasattr(self, "_process_url_" + name):
+                self.processor_ttls[name] = int(ttl)
+        self.persistent_cache = None
+        if cache_file := self.config.get("cache_file"):
+            self.persistent_cache = PersistentUrlCache(
+                cache_file, max_entries=int(self.config.get("cache_file_size", 10000))
+            )
+
+        self.youtube_videos = BatchLookup(
+            self._fetch_youtube_videos,
+            UrlCache(max_entries=1024, ttl=self.processor_ttls["youtube"]),
+            window=float(self.config.get("youtube_batch_window", 0.05)),
+        )
+
+        # PRAW does its requests synchronously, so give it its own small pool
+        # to be able to give up on it after reddit_timeout seconds
+        self.reddit_executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="urlinfo-reddit"
+        )
+        self.reddit_things = UrlCache(
+            max_entries=1024, ttl=self.processor_ttls["reddit"]
+        )
+
+        # Lookups use blocking I/O, so they are run off the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(self.config.get("workers", 4)),
+            thread_name_prefix="urlinfo",
+        )
+
+        # Parsing is CPU-bound and would hold the GIL, so large pages are
+        # parsed in other processes. Those are replaced after a while, so
+        # that they do not grow forever.
+        self.parse_inline_bytes = int(self.config.get("parse_inline_bytes", 65536))
+        self.parse_timeout = float(self.config.get("parse_timeout", 2))
+        self.parser_pool = self._new_parser_pool()
+
+        self.breakers = HostBreakers(
+            threshold=int(self.config.get("breaker_threshold", 3)),
+            cooldown=int(self.config.get("breaker_cooldown", 300)),
+        )
+
+        self.reply_deadline = float(self.config.get("reply_deadline", 2))
+        self.reply_timeout = float(self.config.get("reply_timeout", 15))
+        self.queue = LookupQueue(
+            self._run_lookup,
+            concurrency=int(self.config.get("workers", 4)),
+            capacity=int(self.config.get("queue_size", 64)),
+        )
+
         # URL processors
-        self.url_processors: List[Callable[..., Optional[list[str]]]] = [
+        self.url_processors: List[UrlProcessor] = [
             self._process_url_local,
             self._process_url_urlmap,
-            self._process_url_twitter,
-            self._process_url_reddit,
-            self._process_url_youtube,
+            self._process_url_mastodon,
             self._process_url_default,
         ]
+        self.site_processors = HostIndex()
+        self._site_specific: Set[UrlProcessor] = set()
+        self.register_processor(
+            self._process_url_twitter, hosts=["x.com"], domains=["twitter.com"]
+        )
+        self.register_processor(self._process_url_reddit, domains=["reddit.com"])
+        self.register_processor(self._process_url_wikipedia, domains=["wikipedia.org"])
+        self.register_processor(self._process_url_github, hosts=["github.com"])
+        self.oembed_endpoints = dict(OEMBED_ENDPOINTS)
+        for domain, endpoint in self.bot.config.get(__name__ + ".oembed", {}).items():
+            # irc3 adds some default keys to every section, skip those
+            if domain not in IRC3_CONFIG_DEFAULTS:
+                self.oembed_endpoints[domain] = endpoint
+        self.register_processor(
+            self._process_url_oembed, domains=list(self.oembed_endpoints)
+        )
+        self.register_processor(
+            self._process_url_youtube,
+            hosts=["youtu.be"],
+            domains=["youtube.com", "youtube-nocookie.com"],
+        )
+
+    def register_processor(
+        self,
+        processor: UrlProcessor,
+        hosts: Iterable[str] = (),
+        domains: Iterable[str] = (),
+    ) -> None:
+        """Add a processor for the urls of some sites
+
+        ``hosts`` are matched exactly, ``domains`` also match their
+        subdomains. The processor is only run for urls on those hosts, after
+        the generic processors and before :meth:`_process_url_default`.
+        It is called as ``processor(session, url, parsed=urlsplit(url))``.
+        """
+        self.url_processors.insert(
+            self.url_processors.index(self._process_url_default), processor
+        )
+        self.site_processors.add(processor, hosts, domains)
+        self._site_specific.add(processor)
+
+    def _processors_for(self, hostname: str) -> List[UrlProcessor]:
+        """The processor chain for urls on this host"""
+        matching = self.site_processors.lookup(hostname)
+        return [
+            processor
+            for processor in self.url_processors
+            if processor not in self._site_specific or processor in matching
+        ]
 
     def _process_url(
         self, session: requests.Session, url: str, **kwargs
     ) -> Optional[list[str]]:
-        i = 0
+        return self._run_processors(session, url, **kwargs)[0]
+
+    def _run_processors(
+        self, session: requests.Session, url: str, **kwargs
+    ) -> Tuple[Optional[list[str]], Optional[str]]:
+        """Run the processor chain, also returns the name of the processor"""
         redirects = 0
-        while i < len(self.url_processors):
-            function = self.url_processors[i]
-            i += 1
+        hops: List[Tuple[str, Optional[int]]] = []
+        known = self.redirect_cache.get(self.canonicalize(url))
+        if known is not None:
+            self.log.debug("Known redirect %s -> %s", url, known[0])
+            url = known[0]
+        while True:
+            parsed = urlsplit(url)
             try:
-                self.log.debug("Processing %s via %s", url, function.__name__)
-                result = function(session, url, **kwargs)
-                if result is not None:
-                    return result
+                for function in self._processors_for(parsed.hostname or ""):
+                    self.log.debug("Processing %s via %s", url, function.__name__)
+                    result = function(session, url, parsed=parsed, **kwargs)
+                    if result is not None:
+                        self._remember_redirects(hops, url)
+                        return result, function.__name__.removeprefix("_process_url_")
+                self._remember_redirects(hops, url)
+                return None, None
             except UrlRedirectException as e:
                 if redirects > 10:
-                    return ["Too many redirects."]
-                url = e.next
+                    return ["Too many redirects."], None
+                hops.append((url, e.status))
+                url = self.canonicalize(e.next)
                 redirects += 1
-                i = 0
             except UrlSkipException:
-                return None
+                return None, None
 
-        return None
+    def _remember_redirects(
+        self, hops: List[Tuple[str, Optional[int]]], final_url: str
+    ) -> None:
+        """Cache where a chain of redirects ended up
+
+        Permanent redirects are remembered for ``redirect_ttl`` seconds,
+        a chain with a temporary redirect only for ``temporary_redirect_ttl``.
+        Chains of only url map redirects are not worth remembering.
+        """
+        statuses = [status for _url, status in hops if status is not None]
+        if not statuses:
+            return
+        if all(status in (301, 308) for status in statuses):
+            ttl = self.redirect_ttl
+        else:
+            ttl = self.temporary_redirect_ttl
+        for url, _status in hops:
+            self.redirect_cache.put(self.canonicalize(url), [final_url], ttl)
 
-    def _process_url_local(self, _session, url: str, **kwargs):
+    def _process_url_local(self, _session, url: str, parsed: SplitResult, **kwargs):
+        """Skip urls of hosts that are not on the internet"""
+        hostname = (parsed.hostname or "").rstrip(".")
+        if ("." not in hostname and ":" not in hostname) or hostname.endswith(
+            LOCAL_DOMAINS
+        ):
+            raise UrlSkipException()
         try:
-            # filter out private addresses
-            # May raise exceptions
-            for _f, _t, _p, _c, sockaddr in socket.getaddrinfo(
-                urlparse(url).hostname, None
-            ):
-                ip = ipaddress.ip_address(sockaddr[0])
-                if (
-                    ip.is_private
-                    or ip.is_loopback
-                    or ip.is_link_local
-                    or ip.is_reserved
-                ):
-                    raise UrlSkipException()
-        except Exception:
+            addresses = self.resolver.resolve(hostname)
+        except (OSError, UnicodeError):
+            # Often a typo, but maybe temporary, so do not remember it for long
+            self.log.debug("Could not resolve %s", hostname, exc_info=True)
+            raise UrlErrorException()
+        try:
+            public = all(_is_public_address(address) for address in addresses)
+        except ValueError:
+            public = False
+        if not public:
             raise UrlSkipException()
 
-    def _process_url_urlmap(self, session, url: str, **kwargs) -> None:
-        o = urlparse(url)
-        assert o.hostname is not None
-        if o.hostname in self.urlmap:
-            url = url.replace(o.hostname, self.urlmap[o.hostname], 1)
+    def _process_url_urlmap(
+        self, session, url: str, parsed: SplitResult, **kwargs
+    ) -> None:
+        if parsed.hostname in self.urlmap:
+            url = url.replace(parsed.hostname, self.urlmap[parsed.hostname], 1)
             raise UrlRedirectException(url)
 
-    def _process_url_reddit(self, session: requests.Session, url: str, **kwargs):
+    def _process_url_reddit(
+        self, session: requests.Session, url: str, parsed: SplitResult, **kwargs
+    ):
         """Get reddit information through the api."""
-        urlinfo = urlparse(url)
-        assert urlinfo.hostname is not None
-        if not (
-            urlinfo.hostname == "reddit.com" or urlinfo.hostname.endswith(".reddit.com")
-        ):
-            return
         if self.praw is None:
             return ["Reddit support is not enabled, API key not provided."]
 
-        try:
-            if match := REDDIT_USER_PATTERN.match(urlinfo.path):
-                return [f"/u/{match.group(1)} on Reddit"]
+        if match := REDDIT_USER_PATTERN.match(parsed.path):
+            return [f"/u/{match.group(1)} on Reddit"]
 
+        for kind, model in (
+            ("t1", praw.models.Comment),
+            ("t3", praw.models.Submission),
+        ):
             try:
                 # Separately parse so that we prevent the not-found error
-                comment_id = praw.models.Comment.id_from_url(url)
-                comment = self.praw.comment(comment_id)
-                return [
-                    f"/{comment.submission.subreddit.display_name_prefixed}",
-                    "comment by",
-                    comment.author.name,
-                    "on",
-                    f"“{comment.submission.title}”",
-                ]
-            except prawcore.exceptions.NotFound:
-                return ["Comment not found"]
+                thing_id = model.id_from_url(url)
             except praw.exceptions.InvalidURL:
-                pass
-
+                continue
+            future = self.reddit_executor.submit(
+                self._reddit_message, f"{kind}_{thing_id}"
+            )
             try:
-                # Separately parse so that we prevent the not-found error
-                submission_id = praw.models.Submission.id_from_url(url)
-                submission = self.praw.submission(submission_id)
-                return [
-                    f"/{submission.subreddit.display_name_prefixed}:",
-                    f"“{submission.title}”",
-                    "by",
-                    f"/u/{submission.author}",
-                ]
-            except prawcore.exceptions.NotFound:
-                return ["Subreddit not found"]
-            except praw.exceptions.InvalidURL:
-                pass
+                return future.result(timeout=self.reddit_timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise UrlErrorException("Reddit took too long")
+            except (
+                praw.exceptions.PRAWException,
+                prawcore.exceptions.PrawcoreException,
+            ) as e:
+                self.log.exception("Reddit error")
+                raise UrlErrorException(f"Some exception occurred {e}")
 
-            return ["Reddit."]
+        return ["Reddit."]
 
-        except praw.exceptions.PRAWException as e:
-            self.log.exception("Reddit error")
-            return ["Some exception occurred", str(e)]
-        except prawcore.exceptions.PrawcoreException as e:
-            self.log.exception("Reddit error")
-            return ["Some exception occurred", str(e)]
+    def _reddit_message(self, fullname: str) -> list[str]:
+        """Describe a comment or submission, in at most two API calls"""
+        thing = self._reddit_thing(fullname)
+        if fullname.startswith("t1_"):
+            if thing is None:
+                return ["Comment not found"]
+            subreddit, author, link_id = thing
+            submission = self._reddit_thing(link_id)
+            title = submission[2] if submission is not None else "[removed]"
+            return [f"/{subreddit}", "comment by", author, "on", f"“{title}”"]
+        if thing is None:
+            return ["Submission not found"]
+        subreddit, author, title = thing
+        return [f"/{subreddit}:", f"“{title}”", "by", f"/u/{author}"]
+
+    def _reddit_thing(self, fullname: str) -> Optional[list[str]]:
+        """Get the subreddit, author and title or link of a comment or submission
+
+        These fields are all included in the response of ``/api/info``, so
+        no further requests are needed for the subreddit or the author.
+        """
+        cached = self.reddit_things.get(fullname)
+        if cached is not None:
+            return cached
+        for thing in self.praw.info(fullnames=[fullname]):
+            author = thing.author.name if thing.author is not None else "[deleted]"
+            if isinstance(thing, praw.models.Comment):
+                fields = [thing.subreddit_name_prefixed, author, thing.link_id]
+            else:
+                fields = [thing.subreddit_name_prefixed, author, thing.title]
+            self.reddit_things.put(fullname, fields)
+            return fields
+        return None
 
     def _process_url_twitter(self, session: requests.Session, url, **kwargs):
         """Skip twitter urls because they're no longer useful"""
-        parsed_url = urlparse(url)
-        hostname = parsed_url.hostname
-        if (
-            hostname == "twitter.com"
-            or hostname.endswith(".twitter.com")
-            or hostname == "x.com"
-        ):
-            return ["Twitter (or as Elon would insist, X)"]
+        return ["Twitter (or as Elon would insist, X)"]
 
-    def _process_url_youtube(self, session, url, **kwargs):
+    def _process_url_youtube(self, session, url, parsed: SplitResult, **kwargs):
         """YouTube URLs don't contain a <title>"""
-        self.log.debug("Checking if this is a YouTube URL")
-        parsed_host = urlparse(url)
-        if parsed_host.hostname == "youtu.be" or parsed_host.path.startswith(
-            "/shorts/"
-        ):
+        if parsed.hostname == "youtu.be":
             self.log.debug("Short YouTube URL")
-            video_id = parsed_host.path.lstrip("/")
-        elif parsed_host.hostname in YOUTUBE_URLS:
-            args = parse_qs(parsed_host.query)
-            self.log.debug("Parsed args: '%r'", args)
-            video_id = args.get("v", [])[0]
-            if not video_id:
-                return
+            video_id = parsed.path.lstrip("/")
+        elif parsed.path.startswith("/shorts/"):
+            video_id = parsed.path.removeprefix("/shorts/")
         else:
+            args = parse_qs(parsed.query)
+            self.log.debug("Parsed args: '%r'", args)
+            video_id = args.get("v", [""])[0]
+        if not video_id:
             return
-        url = "https://www.googleapis.com/youtube/v3/videos"
         self.log.debug("Video ID = '%s'", video_id)
+        return self.youtube_videos.get(video_id)
+
+    def _fetch_youtube_videos(self, video_ids: List[str]) -> Dict[str, list[str]]:
+        """Look up a batch of at most 50 videos with one API call"""
+        url = "https://www.googleapis.com/youtube/v3/videos"
         params = {
-            "id": video_id,
+            "id": ",".join(video_ids),
             "hl": "en",
             "key": self.youtube_api_key,
             "part": ["snippet", "contentDetails"],
+            "maxResults": len(video_ids),
         }
-        with closing(session.get(url, params=params, timeout=4)) as response:
+        with closing(self.session.get(url, params=params, timeout=4)) as response:
             try:
                 data = response.json()
                 self.log.debug("Response: %r", data)
                 if response.status_code != 200:
-                    return [f"Got response code {response.status_code}"]
+                    raise UrlErrorException(f"Got response code {response.status_code}")
             except ValueError:
-                return ["Invalid JSON response from YouTube API"]
-            title = data["items"][0]["snippet"]["title"]
-            channel = data["items"][0]["snippet"]["channelTitle"]
+                raise UrlErrorException("Invalid JSON response from YouTube API")
+        videos = {video_id: ["Video not found"] for video_id in video_ids}
+        for item in data.get("items", []):
+            title = item["snippet"]["title"]
+            channel = item["snippet"]["channelTitle"]
             duration = timedelta_format(
-                parse_duration(data["items"][0]["contentDetails"]["duration"])
+                parse_duration(item["contentDetails"]["duration"])
             )
-            return [f"“{title}” ({duration}) — {channel}"]
+            videos[item["id"]] = [f"“{title}” ({duration}) — {channel}"]
+        return videos
 
     def _process_url_default(
-        self, session: requests.Session, url: str, **kwargs
+        self,
+        session: requests.Session,
+        url: str,
+        parsed: Optional[SplitResult] = None,
+        revalidation: Optional[Revalidation] = None,
+        **kwargs,
     ) -> list[str]:
-        """Process an URL"""
+        """Process an URL
+
+        With a ``revalidation``, the request is made conditional on the
+        validators of the cached result.
+        """
+        host = (parsed or urlsplit(url)).hostname or ""
+        if not self.breakers.allow(host):
+            self.log.debug("Breaker for %s is open", host)
+            raise UrlErrorException(self.breakers.last_error(host))
         message = []
+        head: Optional[HeadInfo] = None
+        start_time = time.monotonic()
+        headers = None
+        if revalidation is not None and revalidation.validators is not None:
+            headers = revalidation.validators.request_headers()
         try:
             with closing(
-                session.get(url, allow_redirects=False, timeout=4, stream=True)
+                session.get(
+                    url,
+                    headers=headers,
+                    allow_redirects=False,
+                    timeout=4,
+                    stream=True,
+                )
             ) as response:
+                if response.status_code == 304 and revalidation is not None:
+                    # The body is empty, the cached result is still current
+                    revalidation.not_modified = True
+                    self.breakers.success(host, time.monotonic() - start_time)
+                    return message
                 if response.status_code in (301, 302, 307, 308):
                     if response.next is not None and response.next.url is not None:
-                        raise UrlRedirectException(response.next.url)
+                        raise UrlRedirectException(
+                            response.next.url, response.status_code
+                        )
                 content_type = response.headers.get("Content-Type", "text/html").split(
                     ";"
                 )[0]
-                size = int(response.headers.get("Content-Length", 0))
-
-                # handle chunked transfers
-                content = None
-                if size == 0:
-                    size, content = _read_body(response)
+                is_html = content_type in ("text/html", "application/xhtml+xml")
+                size = _body_size(response.headers)
 
                 self.log.debug("File size: {}".format(repr(size)))
+                if revalidation is not None and response.ok:
+                    revalidation.validators = Validators.from_headers(response.headers)
                 if not response.ok:
                     message.append(f"error: HTTP {response.status_code}")
                     message.append(response.reason.lower())
-                elif size < 0:
-                    message.append("Safety error: unknown size, not reading")
-                elif content_type not in ("text/html", "application/xhtml+xml"):
+                elif is_html:
+                    head = self._parse_page_head(
+                        _read_head_bytes(response),
+                        response.headers.get("Content-Type"),
+                    )
+                else:
+                    # The body is never downloaded, at most its start
+                    details: List[str] = []
+                    if content_type in MEDIA_TYPES:
+                        details, media_size = self._media_info(
+                            session, url, content_type, response
+                        )
+                        size = size if size is not None else media_size
+                    response.close()
+                    if size is None:
+                        size = self._probe_size(session, url)
                     class_, app = content_type.split("/")
-                    if not (
-                        (class_ in self.ignored_classes or app in self.ignored_apps)
-                        and size < (1048576 * 5)
-                    ):
+                    ignored = class_ in self.ignored_classes or app in self.ignored_apps
+                    if details or not ignored or (size or 0) >= 1048576 * 5:
                         message.append("Content-Type:")
                         message.append(content_type)
-                        message.append("Filesize:")
-                        message.append(sizeof_fmt(size))
-                elif size < (1048576 * 2):
-                    soup = BeautifulSoup(
-                        (content or response.content.decode("utf-8", "ignore")),
-                        "html5lib",
-                    )
-                    if soup.title is not None and soup.title.string is not None:
-                        title = soup.title.string.strip()
-                        if len(title) > 320:
-                            title = "{}…".format(title[:310])
-                        message.append("“{}”".format(title))
+                        message.extend(details)
+                        if size is None:
+                            message.append("Filesize: unknown")
+                        else:
+                            message.append("Filesize:")
+                            message.append(sizeof_fmt(size))
             # endwith
         except requests.exceptions.Timeout:
             self.log.debug("Error while requesting %s", url)
-            message.append("Timeout")
+            self.breakers.failure(host, "Timeout", time.monotonic() - start_time)
+            raise UrlErrorException("Timeout")
+        except requests.exceptions.ConnectionError:
+            self.breakers.failure(
+                host, "Connection failed", time.monotonic() - start_time
+            )
+            raise
+        except UrlRedirectException:
+            self.breakers.success(host, time.monotonic() - start_time)
+            raise
+        except Exception:
+            # Also ends a probe, otherwise the breaker would stay open
+            self.breakers.failure(host, "Request failed", time.monotonic() - start_time)
+            raise
+        self.breakers.success(host, time.monotonic() - start_time)
+        if head is not None:
+            # Only now the page is closed and its connection can be reused
+            message.extend(self._head_message(session, url, head))
         return message
 
+    def _head_message(
+        self, session: requests.Session, url: str, head: HeadInfo
+    ) -> list[str]:
+        """Describe a page from its head
+
+        Many sites only put their name in ``<title>``, then the title in
+        their OpenGraph or Twitter card metadata is used instead. If there
+        is no title at all, the oEmbed data the page links to is tried.
+        """
+        site_name = head.meta.get("og:site_name", "").strip()
+        hostname = (urlsplit(url).hostname or "").lower()
+        generic = {"", site_name.lower(), hostname, hostname.removeprefix("www.")}
+        title = (head.title or "").strip()
+        if title.lower() in generic:
+            title = (
+                head.meta.get("og:title") or head.meta.get("twitter:title") or title
+            ).strip()
+        if not title:
+            if head.oembed is not None:
+                return self._fetch_oembed(session, urljoin(url, head.oembed)) or []
+            return []
+        if len(title) > 320:
+            title = "{}…".format(title[:310])
+        message = ["“{}”".format(title)]
+        if site_name and site_name.lower() not in title.lower():
+            message.append(f"— {site_name}")
+        return message
+
+    def _process_url_oembed(
+        self, session: requests.Session, url: str, parsed: SplitResult, **kwargs
+    ) -> Optional[list[str]]:
+        """Ask the oEmbed endpoint of the site instead of loading the page"""
+        hostname = parsed.hostname or ""
+        for domain, endpoint in self.oembed_endpoints.items():
+            if hostname == domain or hostname.endswith("." + domain):
+                return self._fetch_oembed(session, endpoint, url)
+        return None
+
+    def _fetch_json(
+        self,
+        session: requests.Session,
+        url: str,
+        params: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Optional[Any]:
+        """Get a (small) JSON document, or None if that did not work
+
+        One redirect is followed, APIs use those for renamed resources.
+        """
+        try:
+            for _ in range(2):
+                with closing(
+                    session.get(
+                        url,
+                        params=params,
+                        headers={"Accept": "application/json", **(headers or {})},
+                        allow_redirects=False,
+                        timeout=4,
+                        stream=True,
+                    )
+                ) as response:
+                    location = response.headers.get("Location")
+                    if response.status_code in (301, 302, 303, 307, 308) and location:
+                        url, params = urljoin(url, location), None
+                        continue
+                    if not response.ok:
+                        self.log.debug("HTTP %d from %s", response.status_code, url)
+                        return None
+                    size, body = _read_body(response, 1048576)
+                return json.loads(body) if size >= 0 else None
+        except (requests.exceptions.RequestException, ValueError):
+            self.log.debug("No JSON at %s", url, exc_info=True)
+            return None
+        self.log.debug("Too many redirects from %s", url)
+        return None
+
+    def _process_url_wikipedia(
+        self, session: requests.Session, url: str, parsed: SplitResult, **kwargs
+    ) -> Optional[list[str]]:
+        """Get the summary of a Wikipedia article from the REST API"""
+        if not parsed.path.startswith("/wiki/") or parsed.query:
+            return None
+        host = (parsed.hostname or "").replace(".m.", ".")
+        title = parsed.path.removeprefix("/wiki/")
+        data = self._fetch_json(
+            session, f"https://{host}/api/rest_v1/page/summary/{title}"
+        )
+        if not isinstance(data, dict) or not data.get("title"):
+            return None
+        message = ["“{}”".format(data["title"])]
+        description = data.get("description") or _shorten(data.get("extract", ""))
+        if description:
+            message.append(f"— {description}")
+        return message
+
+    def _process_url_github(
+        self, session: requests.Session, url: str, parsed: SplitResult, **kwargs
+    ) -> Optional[list[str]]:
+        """Describe GitHub repositories, issues and pull requests"""
+        parts = [part for part in parsed.path.split("/") if part]
+        if len(parts) == 2:
+            api_url = "https://api.github.com/repos/{}/{}".format(*parts)
+        elif len(parts) == 4 and parts[2] in ("issues", "pull") and parts[3].isdigit():
+            api_url = "https://api.github.com/repos/{}/{}/issues/{}".format(
+                parts[0], parts[1], parts[3]
+            )
+        else:
+            return None
+        headers = {"Accept": "application/vnd.github+json"}
+        if self.github_token:
+            headers["Authorization"] = f"Bearer {self.github_token}"
+        data = self._fetch_json(session, api_url, headers=headers)
+        if not isinstance(data, dict):
+            return None
+        if "number" in data:
+            kind = "Pull request" if "pull_request" in data else "Issue"
+            return [
+                f"{kind} #{data['number']}:",
+                "“{}”".format(data.get("title", "")),
+                "({})".format(data.get("state", "unknown")),
+                "by",
+                data.get("user", {}).get("login", "unknown"),
+            ]
+        if "full_name" not in data:
+            return None
+        message = [f"{data['full_name']}:"]
+        if data.get("description"):
+            message.append(data["description"])
+        details = ["★ {}".format(data.get("stargazers_count", 0))]
+        if data.get("language"):
+            details.append(data["language"])
+        if data.get("archived"):
+            details.append("archived")
+        message.append("({})".format(", ".join(details)))
+        return message
+
+    def _process_url_mastodon(
+        self, session: requests.Session, url: str, parsed: SplitResult, **kwargs
+    ) -> Optional[list[str]]:
+        """Get posts on Mastodon (compatible) servers from their API
+
+        These can be on any host, so they are recognized by their path.
+        """
+        match = MASTODON_STATUS_PATTERN.match(parsed.path)
+        hostname = parsed.hostname or ""
+        if match is None or self.site_processors.lookup(hostname):
+            return None
+        data = self._fetch_json(
+            session, f"https://{hostname}/api/v1/statuses/{match.group('id')}"
+        )
+        if not isinstance(data, dict) or "account" not in data:
+            return None
+        data = data.get("reblog") or data
+        account = data["account"].get("acct", "")
+        if "@" not in account:
+            account = f"{account}@{hostname}"
+        message = [f"@{account}:"]
+        if data.get("spoiler_text"):
+            message.append("CW: {}".format(data["spoiler_text"]))
+        else:
+            message.append(_shorten(_html_text(data.get("content", ""))))
+        if data.get("media_attachments"):
+            message.append("[{} attachments]".format(len(data["media_attachments"])))
+        return message
+
+    def _fetch_oembed(
+        self, session: requests.Session, endpoint: str, url: Optional[str] = None
+    ) -> Optional[list[str]]:
+        """Describe the oEmbed data at an endpoint
+
+        Returns None if there is no usable data, so the page itself can be
+        looked at instead.
+        """
+        params = {"url": url, "format": "json"} if url is not None else None
+        data = self._fetch_json(session, endpoint, params=params)
+        if not isinstance(data, dict) or not str(data.get("title", "")).strip():
+            return None
+        message = ["“{}”".format(str(data["title"]).strip())]
+        if data.get("author_name"):
+            message.extend(["by", str(data["author_name"])])
+        if data.get("provider_name"):
+            message.append(f"— {data['provider_name']}")
+        return message
+
+    def _new_parser_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=int(self.config.get("parse_workers", 2)),
+            max_tasks_per_child=int(self.config.get("parse_worker_tasks", 100)),
+        )
+
+    def _parse_page_head(self, content: bytes, content_type: Optional[str]) -> HeadInfo:
+        """Parse the head of a page, in the parser pool if it is large"""
+        if len(content) <= self.parse_inline_bytes:
+            return _parse_head(content, content_type)
+        try:
+            future = self.parser_pool.submit(_parse_head, content, content_type)
+            return future.result(timeout=self.parse_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.log.warning("Parsing %d bytes took too long", len(content))
+        except concurrent.futures.process.BrokenProcessPool:
+            self.log.exception("Parser pool broke, starting a new one")
+            old, self.parser_pool = self.parser_pool, self._new_parser_pool()
+            old.shutdown(wait=False)
+        return HeadInfo(None, {})
+
+    def _read_range(
+        self, session: requests.Session, url: str, offset: int
+    ) -> Tuple[bytes, Optional[int], bool]:
+        """Read :data:`MEDIA_BYTES` bytes of a file, starting at ``offset``
+
+        Also returns the size of the file, if the server told it, and if
+        the server supports ranges. Nothing is read if it does not.
+        """
+        with closing(
+            session.get(
+                url,
+                headers={
+                    "Range": f"bytes={offset}-{offset + MEDIA_BYTES - 1}",
+                    "Accept-Encoding": "identity",
+                },
+                allow_redirects=False,
+                timeout=4,
+                stream=True,
+            )
+        ) as response:
+            if response.status_code != 206:
+                return b"", None, False
+            return (
+                _read_body(response, MEDIA_BYTES)[1],
+                _body_size(response.headers),
+                True,
+            )
+
+    def _media_info(
+        self,
+        session: requests.Session,
+        url: str,
+        content_type: str,
+        response: requests.Response,
+    ) -> Tuple[List[str], Optional[int]]:
+        """Describe an image, video or PDF from the start of the file
+
+        Only the first :data:`MEDIA_BYTES` bytes of the ``response`` are
+        read, then it is closed. The movie header of MP4 files is often at
+        the end, it is found by skipping over the boxes before it, with at
+        most two more small requests. Also returns the size of the file,
+        if the server told it in those.
+        """
+        details: List[str] = []
+        size: Optional[int] = None
+        try:
+            data = _read_body(response, MEDIA_BYTES)[1]
+            # Free the connection for the requests below
+            response.close()
+            if content_type in IMAGE_TYPES:
+                dimensions = _image_size(data)
+                if dimensions is not None:
+                    details = ["Dimensions:", "{}×{}".format(*dimensions)]
+            elif content_type in MP4_TYPES:
+                duration, next_box = _mp4_duration(data)
+                offset = 0
+                for _attempt in range(2):
+                    if duration is not None or next_box is None:
+                        break
+                    offset += next_box
+                    if size is not None and offset >= size:
+                        break
+                    data, range_size, ranged = self._read_range(session, url, offset)
+                    if not ranged:
+                        break
+                    size = size if size is not None else range_size
+                    duration, next_box = _mp4_duration(data)
+                if duration is not None:
+                    details = [
+                        "Duration:",
+                        timedelta_format(datetime.timedelta(seconds=duration)),
+                    ]
+            else:
+                pages, title = _pdf_info(data)
+                if title:
+                    details.append("“{}”".format(_shorten(title, 200)))
+                if pages is not None:
+                    details.append(f"{pages} pages")
+        except requests.exceptions.RequestException:
+            self.log.debug("Could not read the start of %s", url, exc_info=True)
+            return [], None
+        except (ValueError, struct.error):
+            self.log.debug("Could not parse the start of %s", url, exc_info=True)
+            return [], size
+        return details, size
+
+    def _probe_size(self, session: requests.Session, url: str) -> Optional[int]:
+        """Find out the size of a file without downloading it
+
+        Tries a HEAD request first, then asks for only the first byte.
+        Compression is turned off so the lengths are those of the file.
+        """
+        with closing(
+            session.head(
+                url,
+                headers={"Accept-Encoding": "identity"},
+                allow_redirects=False,
+                timeout=4,
+            )
+        ) as response:
+            size = _body_size(response.headers) if response.ok else None
+            if size:
+                return size
+        with closing(
+            session.get(
+                url,
+                headers={"Range": "bytes=0-0", "Accept-Encoding": "identity"},
+                allow_redirects=False,
+                timeout=4,
+                stream=True,
+            )
+        ) as response:
+            if response.status_code == 206:
+                return _body_size(response.headers)
+        return None
+
+    def _lookup_url(self, url: str) -> Optional[list[str]]:
+        """Run the processor chain for a single url (blocking)"""
+        url = key = self.canonicalize(url)
+        result = self.cache.get(key)
+        if result is not None:
+            self.log.debug("cache hit for %s", url)
+            return result
+        stale = self.cache.get_stale(key)
+        if stale is not None:
+            self.log.debug("stale cache hit for %s", url)
+            self._refresh_in_background(key, stale)
+            return stale.value
+        if self.persistent_cache is not None:
+            entry = self.persistent_cache.get(key)
+            if entry is not None:
+                self.log.debug("persistent cache hit for %s", url)
+                result, ttl = entry
+                self.cache.put(key, result, int(ttl))
+                return result
+        return self._refresh(key)
+
+    def _refresh(self, url: str, stale: Optional[CacheEntry] = None) -> list[str]:
+        """Look up a url and cache the result
+
+        If there is a ``stale`` result, the server is asked if it changed.
+        If that fails, the stale result is kept and tried again later.
+        """
+        self.log.debug("processing %s", url)
+        revalidation = Revalidation(stale.validators if stale is not None else None)
+        try:
+            result, processor = self._run_processors(
+                self.session, url, revalidation=revalidation
+            )
+        except UrlErrorException as e:
+            if stale is not None:
+                self.log.debug("Could not refresh %s: %s", url, e.message)
+                self.cache.postpone(url, stale, self.cache.error_ttl)
+                return stale.value
+            result = [e.message] if e.message is not None else []
+            self.cache.put(url, result, self.cache.error_ttl, stale_ttl=0)
+            return result
+        except Exception:
+            if stale is not None:
+                self.cache.postpone(url, stale, self.cache.error_ttl)
+            else:
+                self.cache.put(url, [], self.cache.error_ttl, stale_ttl=0)
+            raise
+        if revalidation.not_modified and stale is not None:
+            self.log.debug("%s was not modified", url)
+            result, ttl = stale.value, stale.ttl
+        else:
+            result = result or []
+            ttl = self.processor_ttls.get(processor or "", self.cache.ttl)
+        self.cache.put(url, result, ttl, validators=revalidation.validators)
+        if self.persistent_cache is not None:
+            self.persistent_cache.put(url, result, ttl)
+        return result
+
+    def _refresh_in_background(self, url: str, stale: CacheEntry) -> None:
+        """Refresh a stale result, unless that is already happening"""
+        with self._refreshing_lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def done(future: Future) -> None:
+            with self._refreshing_lock:
+                self._refreshing.discard(url)
+            if future.exception() is not None:
+                self.log.error(
+                    "Exception while refreshing %s", url, exc_info=future.exception()
+                )
+
+        self.executor.submit(self._refresh, url, stale).add_done_callback(done)
+
+    async def _run_lookup(self, url: str) -> Optional[list[str]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._lookup_url, url)
+
+    async def _process_message(self, target, urls: List[str], nick: str = "") -> None:
+        """Look up all urls concurrently and reply as they come in
+
+        Everything that is done within ``reply_deadline`` seconds is sent in
+        one line, urls that take longer get a follow-up line. Lookups that
+        are not done after ``reply_timeout`` seconds are dropped.
+        """
+        loop = asyncio.get_running_loop()
+        hard_deadline = loop.time() + self.reply_timeout
+        # The same link may be in a message more than once
+        urls = [self.canonicalize(url) for url in urls]
+        lookups: Dict[str, asyncio.Future] = {}
+        for url in urls:
+            if url not in lookups:
+                lookups[url] = self.queue.submit(target, nick, url)
+        futures = [lookups[url] for url in urls]
+        done, pending = await asyncio.wait(futures, timeout=self.reply_deadline)
+        self._send_results(target, urls, futures, done)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=max(0, hard_deadline - loop.time()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                break
+            self._send_results(target, urls, futures, done)
+        for future in pending:
+            self.log.debug("Giving up on %s", urls[futures.index(future)])
+            future.cancel()
+
+    def _send_results(
+        self,
+        target,
+        urls: List[str],
+        futures: List[asyncio.Future],
+        done: Set[asyncio.Future],
+    ) -> None:
+        """Send the results of the finished lookups, numbered by position"""
+        messages: List[str] = []
+        sent: Set[asyncio.Future] = set()
+        for index, (url, future) in enumerate(zip(urls, futures), start=1):
+            if future not in done or future in sent:
+                continue
+            sent.add(future)
+            if future.exception() is not None:
+                self.log.error(
+                    "Exception while requesting %s", url, exc_info=future.exception()
+                )
+                continue
+            urlmesg = future.result()
+            if not urlmesg:
+                continue
+            message: list[str] = []
+            if len(urls) > 1:
+                message.append("({})".format(index))
+            message.extend(urlmesg)
+            messages.append(" ".join(message))
+        if messages:
+            self.bot.privmsg(target, "{}.".format(" ".join(messages)))
+
     @event(
         r"^:(?P<mask>\S+!\S+@\S+) (?P<event>(PRIVMSG|NOTICE)) "
-        r"(?P<target>\S+) :\s*(?P<data>(.*(https?://)).*)$"
+        r"(?P<target>\S+) :\s*(?P<data>.*)$"
     )
     def on_message(self, mask, event, target, data):
         if (
-            mask.nick == self.bot.nick
+            "://" not in data
+            or mask.nick == self.bot.nick
             or event == "NOTICE"
             or not target.is_channel
             or target in self.ignored_channels
             or mask.nick in self.ignored_nicks
         ):
             return
-        index = 1
-        messages: List[str] = []
         urls = _find_urls(data)
-        for url in urls:
-            message: list[str] = []
-            if len(urls) > 1:
-                message.append("({})".format(index))
-                index += 1
-            with requests.Session() as session:
-                session.headers.update(
-                    {
-                        "User-Agent": "script:onebot:irc",
-                        "Accept-Language": "en-GB, en-US, en, nl-NL, nl",
-                    }
-                )
-                if self.cookiejar:
-                    session.cookies = self.cookiejar
-                self.log.debug("processing %s", url)
-                try:
-                    urlmesg = self._process_url(session, url)
-                    if not urlmesg:
-                        continue
-                    else:
-                        message.extend(urlmesg)
-                except Exception:
-                    self.log.exception("Exception while requesting %s", url)
-                    continue
-                # end try
-            # end with session
-            if message:
-                messages.append(" ".join(message))
-        if messages:
-            self.bot.privmsg(target, "{}.".format(" ".join(messages)))
+        if urls:
+            asyncio.ensure_future(self._process_message(target, urls, mask.nick))
+
+    @command(permission="admin", show_in_help_list=False)
+    def urlinfo(self, mask, target, args):
+        """Show statistics of the urlinfo plugin
+
+        %%urlinfo (stats|breakers)
+        """
+        if args["breakers"]:
+            self.bot.privmsg(target, self.breakers.stats())
+            return
+        self.bot.privmsg(
+            target,
+            "; ".join([self.cache.stats(), self.resolver.stats(), self.queue.stats()]),
+        )
 
     @classmethod
     def reload(cls, old: Self) -> Self:  # pragma: no cover
+        old.executor.shutdown(wait=False)
+        old.reddit_executor.shutdown(wait=False)
+        old.parser_pool.shutdown(wait=False, cancel_futures=True)
+        old.session.close()
+        if old.persistent_cache is not None:
+            old.persistent_cache.close()
         return cls(old.bot)
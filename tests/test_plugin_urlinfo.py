@@ -8,25 +8,60 @@ test_onebot_urlinfo
 Tests for urlinfo module.
 """
 
+import asyncio
+import concurrent.futures
+import gzip
+import http.server
+import io
+import json
 import os.path
 import logging
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock
+import zlib
+from contextlib import closing
+from unittest.mock import MagicMock, patch
 from pathlib import Path
+from urllib.parse import urlsplit
 import os
 
 import betamax
+import irc3.utils
+import praw.models
 
 from onebot.testing import BotTestCase
-from onebot.plugins.urlinfo import _find_urls
+from onebot.plugins.urlinfo import (
+    BatchLookup,
+    HeadInfo,
+    HostBreakers,
+    HostIndex,
+    HostResolver,
+    LookupQueue,
+    PersistentUrlCache,
+    UrlCache,
+    UrlCanonicalizer,
+    UrlErrorException,
+    Validators,
+    VettedAddressAdapter,
+    _find_urls,
+    _image_size,
+    _iter_decoded,
+    _parse_head,
+    _read_body,
+    _read_head_bytes,
+)
 
 import requests
+import urllib3
 
 from .test_plugin_users import MockDb
 
 from betamax import Betamax
 
-
 with Betamax.configure() as config:
     config.cassette_library_dir = "tests/fixtures/cassettes"
 
@@ -50,7 +85,10 @@ def mock_requests_get(*args, **kwargs):
                 "Content-Length": "{}".format(self._file_size),
             }
             self.content = self._file_name.read_bytes()
-            self._filehandle = self._file_name.open()
+            self._filehandle = self._file_name.open("rb")
+
+        def iter_content(self, chunk_size=1):
+            return iter(lambda: self._filehandle.read(chunk_size), b"")
 
         def close(self, *args, **kwargs):
             self._filehandle.close()
@@ -58,6 +96,62 @@ def mock_requests_get(*args, **kwargs):
     return MockResponse()
 
 
+URL_FINDER_CASES = [
+    ("https://nos.nl", ["https://nos.nl"]),
+    ("Ga naar https://nos.nl.", ["https://nos.nl"]),
+    ("Ga naar https://nos.nl,", ["https://nos.nl"]),
+    (
+        "Ga naar https://nos.nl, https://nos.nl",
+        ["https://nos.nl", "https://nos.nl"],
+    ),
+    ("https://nos.nl/test)", ["https://nos.nl/test"]),
+    ("http://nos.nl:80/test)", ["http://nos.nl:80/test"]),
+    ("http://nos.nl:80/(test)", ["http://nos.nl:80/(test)"]),
+    ("(http://nos.nl/(test))", ["http://nos.nl/(test)"]),
+    ("http://nos.nl/(test)test)", ["http://nos.nl/(test)test"]),
+    ("<http://nos.nl/test>", ["http://nos.nl/test"]),
+]
+
+
+def run_in_new_loop(coroutine):
+    """Run a coroutine without touching the current event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def make_response(status_code=200, headers=None, chunks=()):
+    """Build a streamed response with the given body chunks"""
+    response = MagicMock(spec=requests.Response)
+    response.status_code = status_code
+    response.ok = status_code < 400
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response.iter_content.side_effect = lambda chunk_size: iter(chunks)
+    return response
+
+
+def read_head(response):
+    """Download and parse the head of a document, like the default processor"""
+    return _parse_head(_read_head_bytes(response), response.headers.get("Content-Type"))
+
+
+def compressed_response(encoding, body):
+    """Build a real streamed response with an encoded body"""
+    response = requests.Response()
+    response.status_code = 200
+    response.headers = requests.structures.CaseInsensitiveDict(
+        {"Content-Type": "text/html", "Content-Encoding": encoding}
+    )
+    response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body),
+        headers=dict(response.headers),
+        preload_content=False,
+    )
+    return response
+
+
 class UrlInfoTestCase(BotTestCase):
     """Test the URLInfo module"""
 
@@ -90,26 +184,187 @@ class UrlInfoTestCase(BotTestCase):
         self.assertFalse(self.plugin._process_url(None, "http://[::1]/"))
         self.assertFalse(self.plugin._process_url(None, "http://10.0.0.1/"))
 
+    def test_resolve_error_not_cached_long(self):
+        """A failed DNS lookup is silently remembered for a short while"""
+        self.plugin.resolver.resolve = MagicMock(side_effect=socket.gaierror())
+        self.plugin.persistent_cache = MagicMock()
+        self.plugin.persistent_cache.get.return_value = None
+        url = "https://example.com/"
+        self.assertEqual(self.plugin._lookup_url(url), [])
+        entry = self.plugin.cache._entries[url]
+        self.assertEqual(entry.ttl, self.plugin.cache.error_ttl)
+        self.assertEqual(entry.stale_until, entry.expires)
+        self.plugin.persistent_cache.put.assert_not_called()
+
+    def test_resolver_cache(self):
+        resolver = HostResolver(ttl=60)
+        addrinfo = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("1.1.1.1", 0))] * 2
+        with patch("socket.getaddrinfo", return_value=addrinfo) as getaddrinfo:
+            self.assertEqual(resolver.resolve("example.com"), ["1.1.1.1"])
+            self.assertEqual(resolver.resolve("example.com"), ["1.1.1.1"])
+            getaddrinfo.assert_called_once_with("example.com", None)
+        self.assertEqual(resolver.stats(), "DNS: 1 lookups, 1 cached")
+
+        resolver.ttl = -1
+        with patch("socket.getaddrinfo", return_value=addrinfo) as getaddrinfo:
+            resolver.resolve("example.org")
+            resolver.resolve("example.org")
+            self.assertEqual(getaddrinfo.call_count, 2)
+
+    def test_resolver_concurrent_lookups(self):
+        resolver = HostResolver()
+        addrinfo = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("1.1.1.1", 0))]
+        release = threading.Event()
+
+        def slow_getaddrinfo(*args):
+            release.wait(1)
+            return addrinfo
+
+        with patch("socket.getaddrinfo", side_effect=slow_getaddrinfo) as getaddrinfo:
+            threads = [
+                threading.Thread(target=resolver.resolve, args=("example.com",))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+            getaddrinfo.assert_called_once()
+
+    def test_connect_to_vetted_address(self):
+        """The connection goes to the address that the resolver checked"""
+        hosts = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                hosts.append(self.headers["Host"])
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        resolver = MagicMock(spec=HostResolver)
+        resolver.resolve.return_value = ["127.0.0.1"]
+        try:
+            with requests.Session() as session:
+                session.mount("http://", VettedAddressAdapter(resolver))
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    session.get(f"http://pinned.example:{port}/", timeout=1)
+                with patch(
+                    "onebot.plugins.urlinfo._is_public_address", return_value=True
+                ):
+                    response = session.get(f"http://pinned.example:{port}/", timeout=1)
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(hosts, [f"pinned.example:{port}"])
+            resolver.resolve.assert_called_with("pinned.example")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_pool_timeout(self):
+        """A request does not wait forever for a free connection"""
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "100000")
+                self.end_headers()
+                self.wfile.write(b"a" * 100000)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        resolver = MagicMock(spec=HostResolver)
+        resolver.resolve.return_value = ["127.0.0.1"]
+        adapter = VettedAddressAdapter(
+            resolver, pool_maxsize=1, pool_block=True, pool_timeout=0.1
+        )
+        try:
+            with requests.Session() as session, patch(
+                "onebot.plugins.urlinfo._is_public_address", return_value=True
+            ):
+                session.mount("http://", adapter)
+                url = f"http://pool.example:{port}/"
+                with closing(session.get(url, stream=True, timeout=1)):
+                    with self.assertRaises(requests.exceptions.ConnectionError):
+                        session.get(url, timeout=1)
+                self.assertEqual(session.get(url, timeout=1).status_code, 200)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_host_index(self):
+        index = HostIndex()
+        index.add("a", hosts=["example.com"])
+        index.add("b", domains=["example.com"])
+        index.add("c", hosts=["www.example.com"], domains=["example.org"])
+        self.assertEqual(index.lookup("example.com"), {"a", "b"})
+        self.assertEqual(index.lookup("WWW.example.com."), {"b", "c"})
+        self.assertEqual(index.lookup("m.example.org"), {"c"})
+        self.assertEqual(index.lookup("example.net"), set())
+        self.assertEqual(index.lookup("com"), set())
+
+    def test_register_processor(self):
+        def site(session, url, parsed, **kwargs):
+            return [parsed.path]
+
+        self.plugin.register_processor(site, domains=["example.com"])
+        self.plugin.resolver.resolve = MagicMock(return_value=["1.1.1.1"])
+        self.assertEqual(
+            self.plugin._processors_for("www.example.com")[-2:],
+            [site, self.plugin._process_url_default],
+        )
+        self.assertNotIn(site, self.plugin._processors_for("example.org"))
+        self.assertNotIn(
+            self.plugin._process_url_youtube,
+            self.plugin._processors_for("example.com"),
+        )
+        self.assertEqual(
+            self.plugin._run_processors(None, "https://example.com/path"),
+            (["/path"], "site"),
+        )
+
     def test_url_finder(self):
-        for message, expected in [
-            ("https://nos.nl", ["https://nos.nl"]),
-            ("Ga naar https://nos.nl.", ["https://nos.nl"]),
-            ("Ga naar https://nos.nl,", ["https://nos.nl"]),
-            (
-                "Ga naar https://nos.nl, https://nos.nl",
-                ["https://nos.nl", "https://nos.nl"],
-            ),
-            ("https://nos.nl/test)", ["https://nos.nl/test"]),
-            ("http://nos.nl:80/test)", ["http://nos.nl:80/test"]),
-            ("http://nos.nl:80/(test)", ["http://nos.nl:80/(test)"]),
-            ("(http://nos.nl/(test))", ["http://nos.nl/(test)"]),
-            ("http://nos.nl/(test)test)", ["http://nos.nl/(test)test"]),
-            ("<http://nos.nl/test>", ["http://nos.nl/test"]),
-        ]:
+        for message, expected in URL_FINDER_CASES:
             self.assertEqual(
                 expected, _find_urls(message), "String: {}".format(message)
             )
 
+    def test_url_finder_benchmark(self):
+        """Finding urls is fast and takes linear time"""
+        with open(Path(__file__).parent / "fixtures/irc_lines.json") as f:
+            corpus = [tuple(case) for case in json.load(f)] + URL_FINDER_CASES
+        for message, expected in corpus:
+            self.assertEqual(expected, _find_urls(message), message)
+
+        lines = [message for message, _expected in corpus] * 200
+        start = time.perf_counter()
+        for line in lines:
+            _find_urls(line)
+        elapsed = time.perf_counter() - start
+        self.assertGreater(len(lines) / elapsed, 20000, "lines per second")
+
+        for brackets in [1000, 8000]:
+            line = "zie https://example.com/" + "(a)" * brackets + ")" * brackets
+            start = time.perf_counter()
+            (url,) = _find_urls(line)
+            elapsed = time.perf_counter() - start
+            self.assertTrue(url.endswith("(a)"))
+            self.assertLess(elapsed, 0.05, f"{brackets} brackets")
+
     def test_too_long_title_text(self):
         """Don't show very long title texts"""
         session = MagicMock()
@@ -119,6 +374,916 @@ class UrlInfoTestCase(BotTestCase):
         self.assertLess(100, len(" ".join(result)), "text too short")
         self.assertGreater(320, len(" ".join(result)), "text too long")
 
+    def test_urls_processed_concurrently(self):
+        """A slow url should not hold up the others"""
+
+        def slow_run_processors(session, url, **kwargs):
+            time.sleep(0.2)
+            return [url.rsplit("/", 1)[1]], "default"
+
+        self.plugin._run_processors = slow_run_processors
+        self.bot.privmsg = MagicMock()
+        urls = [
+            "https://example.com/a",
+            "https://example.com/b",
+            "https://example.com/c",
+        ]
+        start = time.monotonic()
+        run_in_new_loop(self.plugin._process_message("#chan", urls))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.bot.privmsg.assert_called_once_with("#chan", "(1) a (2) b (3) c.")
+
+    def test_incremental_replies(self):
+        delays = {"a": 0, "b": 0.3, "c": 0.02, "d": 5}
+
+        async def run_lookup(url):
+            await asyncio.sleep(delays[url])
+            return [url]
+
+        self.plugin.queue.run = run_lookup
+        self.plugin.reply_deadline = 0.1
+        self.plugin.reply_timeout = 0.5
+        self.bot.privmsg = MagicMock()
+        run_in_new_loop(self.plugin._process_message("#chan", list("abcd")))
+        self.assertEqual(
+            [c.args for c in self.bot.privmsg.call_args_list],
+            [("#chan", "(1) a (3) c."), ("#chan", "(2) b.")],
+        )
+
+    def test_canonical_urls(self):
+        canonicalize = UrlCanonicalizer()
+        for url, expected in [
+            ("http://NOS.nl.:80", "http://nos.nl/"),
+            ("https://nos.nl:8443/a/", "https://nos.nl:8443/a/"),
+            ("https://[::1]:443/", "https://[::1]/"),
+            ("https://a.b/?utm_source=x&utm_medium=y", "https://a.b/"),
+            ("https://a.b/?q=a%20b&fbclid=1&UTM=2", "https://a.b/?UTM=2&q=a%20b"),
+            ("https://a.b/?z=1&a=2&a=1", "https://a.b/?a=2&a=1&z=1"),
+            ("https://a.b/?feature=youtu.be", "https://a.b/?feature=youtu.be"),
+        ]:
+            with self.subTest(url=url):
+                self.assertEqual(canonicalize(url), expected)
+        canonicalize = UrlCanonicalizer(
+            ["ref"], sort_query=False, strip_trailing_slash=True
+        )
+        self.assertEqual(
+            canonicalize("https://a.b/c/?z=1&ref=x&a=2&si=3"),
+            "https://a.b/c?z=1&a=2&si=3",
+        )
+
+    def test_duplicate_urls_looked_up_once(self):
+        lookups = []
+
+        async def run_lookup(url):
+            lookups.append(url)
+            return [url]
+
+        self.plugin.queue.run = run_lookup
+        self.bot.privmsg = MagicMock()
+        urls = [
+            "https://nos.nl/a?utm_source=x",
+            "https://example.com",
+            "HTTPS://NOS.NL/a#top",
+        ]
+        run_in_new_loop(self.plugin._process_message("#chan", urls))
+        self.assertEqual(lookups, ["https://nos.nl/a", "https://example.com/"])
+        self.bot.privmsg.assert_called_once_with(
+            "#chan", "(1) https://nos.nl/a (2) https://example.com/."
+        )
+
+    def test_on_message_prefilter(self):
+        self.plugin._process_message = MagicMock()
+        with patch("asyncio.ensure_future") as ensure_future:
+            self.bot.dispatch(":someone!user@host PRIVMSG #chan :no links here")
+            self.bot.dispatch(":someone!user@host PRIVMSG #chan :see https://nos.nl.")
+            ensure_future.assert_called_once()
+        self.plugin._process_message.assert_called_once_with(
+            "#chan", ["https://nos.nl"], "someone"
+        )
+
+    def test_lookup_queue_fair(self):
+        order = []
+
+        async def run(url):
+            order.append(url)
+            await asyncio.sleep(0)
+            return [url]
+
+        async def flood():
+            queue = LookupQueue(run, concurrency=1, capacity=4)
+            spam = [queue.submit("#spam", "spammer", f"s{i}") for i in range(5)]
+            other = [
+                queue.submit("#spam", "friend", "f1"),
+                queue.submit("#chan", "someone", "c1"),
+            ]
+            results = await asyncio.gather(*spam, *other)
+            return queue, results
+
+        queue, results = run_in_new_loop(flood())
+        # s0 started right away, the oldest waiting spam was dropped twice
+        self.assertEqual(results, [["s0"], None, None, ["s3"], ["s4"], ["f1"], ["c1"]])
+        self.assertEqual(order, ["s0", "s3", "c1", "f1", "s4"])
+        self.assertEqual(queue.stats(), "Queue: 0 waiting, 0 running, 2 dropped")
+
+    def test_shared_session(self):
+        """All lookups go through the same pooled session"""
+        self.plugin._run_processors = MagicMock(return_value=(["ok"], None))
+        self.plugin._lookup_url("https://example.com/a")
+        self.plugin._lookup_url("https://example.org/b")
+        sessions = {c.args[0] for c in self.plugin._run_processors.call_args_list}
+        self.assertEqual(sessions, {self.plugin.session})
+        adapter = self.plugin.session.get_adapter("https://example.com")
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertTrue(adapter._pool_block)
+
+    def test_cache(self):
+        cache = UrlCache(max_entries=2, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", ["A"])
+        cache.put("b", ["B"])
+        self.assertEqual(cache.get("a"), ["A"])
+        cache.put("c", ["C"])
+        # b was least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), ["C"])
+        cache.put("a", ["A"], ttl=-1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 3, 1))
+
+    def test_cache_stale(self):
+        cache = UrlCache(ttl=60, stale_ttl=60)
+        cache.put("a", ["A"], ttl=-1, validators=Validators('"1"', None))
+        cache.put("b", ["B"], ttl=-1, stale_ttl=0)
+        cache.put("c", ["C"])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get_stale("a").value, ["A"])
+        self.assertEqual(cache.get_stale("a").validators, Validators('"1"', None))
+        self.assertIsNone(cache.get_stale("b"))
+        self.assertIsNone(cache.get_stale("c"))
+
+    def test_revalidation(self):
+        """An unmodified page is not downloaded again"""
+        self.plugin.resolver.resolve = MagicMock(return_value=["93.184.216.34"])
+        url = "https://example.com/"
+        page = make_response(
+            headers={"Content-Type": "text/html", "ETag": '"v1"'},
+            chunks=[b"<title>Title</title></head>"],
+        )
+        self.plugin.session = MagicMock()
+        self.plugin.session.get.return_value = page
+        self.assertEqual(self.plugin._refresh(url), ["“Title”"])
+        self.assertIsNone(self.plugin.session.get.call_args.kwargs["headers"])
+
+        entry = self.plugin.cache._entries[url]
+        self.assertEqual(entry.validators, Validators('"v1"', None))
+        self.plugin.session.get.return_value = make_response(304)
+        stale = entry._replace(value=["“Old”"], expires=0)
+        self.assertEqual(self.plugin._refresh(url, stale), ["“Old”"])
+        self.assertEqual(
+            self.plugin.session.get.call_args.kwargs["headers"],
+            {"If-None-Match": '"v1"'},
+        )
+        self.assertEqual(self.plugin.cache.get(url), ["“Old”"])
+
+    def test_failed_refresh_keeps_stale(self):
+        """A result that could not be refreshed is kept for a while longer"""
+        url = "https://example.com/"
+        self.plugin.cache.put(
+            url, ["“Old”"], ttl=-1, validators=Validators('"1"', None)
+        )
+        stale = self.plugin.cache.get_stale(url)
+        for error in [UrlErrorException("Timeout"), ValueError()]:
+            with self.subTest(error=error):
+                self.plugin._run_processors = MagicMock(side_effect=error)
+                if isinstance(error, UrlErrorException):
+                    self.assertEqual(self.plugin._refresh(url, stale), ["“Old”"])
+                else:
+                    with self.assertRaises(ValueError):
+                        self.plugin._refresh(url, stale)
+                self.assertEqual(self.plugin.cache.get(url), ["“Old”"])
+                entry = self.plugin.cache._entries[url]
+                self.assertEqual(entry.ttl, stale.ttl)
+                self.assertEqual(entry.validators, stale.validators)
+                self.assertEqual(entry.stale_until, stale.stale_until)
+
+    def test_stale_served_while_refreshing(self):
+        url = "https://example.com/"
+        self.plugin.cache.put(url, ["“Old”"], ttl=-1)
+        refreshing = threading.Event()
+        finish = threading.Event()
+
+        def refresh(url, stale):
+            refreshing.set()
+            finish.wait(5)
+            self.plugin.cache.put(url, ["“New”"])
+
+        self.plugin._refresh = MagicMock(side_effect=refresh)
+        self.assertEqual(self.plugin._lookup_url(url), ["“Old”"])
+        self.assertTrue(refreshing.wait(5))
+        self.assertEqual(self.plugin._lookup_url(url), ["“Old”"])
+        finish.set()
+        self.plugin.executor.shutdown(wait=True)
+        self.plugin._refresh.assert_called_once()
+        self.assertEqual(self.plugin._lookup_url(url), ["“New”"])
+
+    def test_lookup_cached(self):
+        self.plugin._run_processors = MagicMock(return_value=(["“Title”"], None))
+        self.assertEqual(self.plugin._lookup_url("https://Example.com/#a"), ["“Title”"])
+        self.assertEqual(self.plugin._lookup_url("https://example.com/"), ["“Title”"])
+        self.plugin._run_processors.assert_called_once()
+
+    def test_lookup_error_cached(self):
+        self.plugin._run_processors = MagicMock(
+            side_effect=UrlErrorException("Timeout")
+        )
+        self.assertEqual(self.plugin._lookup_url("https://example.com/"), ["Timeout"])
+        self.assertEqual(self.plugin._lookup_url("https://example.com/"), ["Timeout"])
+        self.plugin._run_processors.assert_called_once()
+
+        self.plugin._run_processors = MagicMock(side_effect=ValueError())
+        with self.assertRaises(ValueError):
+            self.plugin._lookup_url("https://example.org/")
+        self.assertEqual(self.plugin._lookup_url("https://example.org/"), [])
+
+    def test_persistent_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "urlinfo.sqlite")
+            cache = PersistentUrlCache(filename, max_entries=2)
+            self.assertFalse(os.path.exists(filename), "should be opened lazily")
+            cache.put("a", ["“A”"], 60)
+            cache.put("b", ["“B”"], -1)
+            cache.close()
+
+            cache = PersistentUrlCache(filename, max_entries=2)
+            value, ttl = cache.get("a")
+            self.assertEqual(value, ["“A”"])
+            self.assertLessEqual(ttl, 60)
+            self.assertIsNone(cache.get("b"))
+            cache.put("c", ["“C”"], 60)
+            cache.put("d", ["“D”"], 60)
+            cache.compact()
+            self.assertIsNone(cache.get("a"))
+            self.assertIsNotNone(cache.get("d"))
+            cache.close()
+
+    def test_lookup_processor_ttl(self):
+        self.plugin.persistent_cache = MagicMock()
+        self.plugin.persistent_cache.get.return_value = None
+        self.plugin._process_url_youtube = MagicMock(
+            return_value=["“Video”"], __name__="_process_url_youtube"
+        )
+        self.plugin.url_processors = [self.plugin._process_url_youtube]
+        self.plugin._lookup_url("https://youtu.be/abc")
+        self.plugin.persistent_cache.put.assert_called_once_with(
+            "https://youtu.be/abc", ["“Video”"], 3 * 86400
+        )
+
+    def test_config_file_sections(self):
+        """The cache_ttl and oembed sections are read from a config file"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "config.ini")
+            with open(filename, "w") as f:
+                f.write(
+                    "[bot]\n[onebot.plugins.urlinfo.cache_ttl]\nyoutube = 100\n"
+                    "[onebot.plugins.urlinfo.oembed]\n"
+                    "example.org = https://example.org/oembed\n"
+                )
+            config = irc3.utils.parse_config("bot", filename)
+        self.callFTU(**config)
+        plugin = self.bot.get_plugin("onebot.plugins.urlinfo.UrlInfo")
+        self.assertEqual(plugin.processor_ttls["youtube"], 100)
+        self.assertNotIn("#", plugin.processor_ttls)
+        self.assertEqual(
+            plugin.oembed_endpoints["example.org"], "https://example.org/oembed"
+        )
+        self.assertNotIn("#", plugin.oembed_endpoints)
+
+    def test_stats_command(self):
+        self.plugin._run_processors = MagicMock(return_value=(["“Title”"], None))
+        self.plugin._lookup_url("https://example.com/")
+        self.plugin._lookup_url("https://example.com/")
+        self.bot.dispatch(":im!the@boss PRIVMSG #chan :!urlinfo stats")
+        self.assertSent(
+            [
+                "PRIVMSG #chan :Cache: 1 entries, 1 hits, 1 misses, 0 evictions; "
+                "DNS: 0 lookups, 0 cached; Queue: 0 waiting, 0 running, 0 dropped"
+            ]
+        )
+
+    def test_read_head_stops_at_head(self):
+        """Only the start of the document is downloaded"""
+        chunks = [
+            b"<!DOCTYPE html><html><head><meta charset=utf-8>",
+            b"<title>Hello &amp; welcome</tit",
+            b"le>",
+            b"<meta property='og:title' content='Hi'></he",
+            b"ad>",
+        ]
+
+        def iter_content(chunk_size):
+            yield from chunks
+            self.fail("Read past </head>")
+
+        response = MagicMock()
+        response.headers = {}
+        response.iter_content = iter_content
+        content = _read_head_bytes(response)
+        self.assertEqual(content, b"".join(chunks))
+        head = _parse_head(content + b"<body><title>Not this</title>", None)
+        self.assertEqual(head.title, "Hello & welcome")
+        self.assertEqual(head.meta, {"og:title": "Hi"})
+
+    def test_read_head_charsets(self):
+        title = "日本語のページ"
+        for content_type, charset, prefix in [
+            ("text/html", "utf-8", ""),
+            ("text/html; charset=Shift_JIS", "shift_jis", ""),
+            ("text/html; charset=GB2312", "gbk", ""),
+            ("text/html", "shift_jis", "<meta charset='Shift_JIS'>"),
+            ("text/html", "utf-16", ""),
+        ]:
+            with self.subTest(content_type=content_type, charset=charset):
+                document = f"{prefix}<title>{title}</title>".encode(charset)
+                # The declaration may be split over several chunks
+                chunks = [document[i : i + 5] for i in range(0, len(document), 5)]
+                response = make_response(
+                    headers={"Content-Type": content_type}, chunks=chunks
+                )
+                self.assertEqual(read_head(response).title, title)
+        document = "<meta charset=windows-1252><title>Café</title>".encode("cp1252")
+        response = make_response(
+            headers={"Content-Type": "text/html"}, chunks=[document]
+        )
+        self.assertEqual(read_head(response).title, "Café")
+
+    def test_parse_in_pool(self):
+        """Large pages are parsed in another process"""
+        document = b"<title>Large page</title>" + b" " * 1000
+        self.addCleanup(self.plugin.parser_pool.shutdown)
+        self.plugin.parse_inline_bytes = 100
+        pool = self.plugin.parser_pool
+        with patch.object(pool, "submit", wraps=pool.submit) as submit:
+            head = self.plugin._parse_page_head(document, "text/html")
+            submit.assert_called_once()
+        self.assertEqual(head, HeadInfo("Large page", {}))
+
+    def test_parse_timeout(self):
+        self.plugin.parser_pool = MagicMock()
+        self.plugin.parser_pool.submit.return_value = concurrent.futures.Future()
+        self.plugin.parse_timeout = 0.01
+        self.assertEqual(
+            self.plugin._parse_page_head(b" " * 100000, "text/html"),
+            HeadInfo(None, {}),
+        )
+        self.assertEqual(
+            self.plugin._parse_page_head(b"<title>Small</title>", "text/html"),
+            HeadInfo("Small", {}),
+        )
+        self.plugin.parser_pool.submit.assert_called_once()
+
+    def test_head_message(self):
+        session = MagicMock()
+        session.get.return_value = make_response(
+            chunks=[b'{"title": "Song", "author_name": "Artist"}']
+        )
+        url = "https://www.example.com/page"
+        meta = {"og:title": "Article", "og:site_name": "Example News"}
+        for head, expected in [
+            (HeadInfo("Article | Example News", meta), ["“Article | Example News”"]),
+            (HeadInfo("Other", meta), ["“Other”", "— Example News"]),
+            (HeadInfo("Example News", meta), ["“Article”", "— Example News"]),
+            (HeadInfo("example.com", {"twitter:title": "Tweet"}), ["“Tweet”"]),
+            (HeadInfo(None, {}), []),
+            (HeadInfo(" ", {}, "/oembed?id=1"), ["“Song”", "by", "Artist"]),
+        ]:
+            with self.subTest(head=head):
+                self.assertEqual(
+                    self.plugin._head_message(session, url, head), expected
+                )
+        self.assertEqual(
+            session.get.call_args.args, ("https://www.example.com/oembed?id=1",)
+        )
+
+    def test_oembed_link_after_page_closed(self):
+        """The page is closed before its oEmbed data is requested"""
+        page = make_response(
+            headers={"Content-Type": "text/html"},
+            chunks=[
+                b"<head><link rel='alternate' type='application/json+oembed' "
+                b"href='/oembed?id=1'></head>"
+            ],
+        )
+        oembed = make_response(chunks=[b'{"title": "Song"}'])
+
+        def get(url, **kwargs):
+            if url == "https://example.com/page":
+                return page
+            page.close.assert_called()
+            return oembed
+
+        session = MagicMock()
+        session.get.side_effect = get
+        self.assertEqual(
+            self.plugin._process_url_default(session, "https://example.com/page"),
+            ["“Song”"],
+        )
+
+    def test_read_head_oembed_link(self):
+        response = make_response(
+            chunks=[
+                b"<head><link rel='alternate' type='application/json+oembed' "
+                b"href='/oembed?url=x'><link rel=alternate href=/feed></head>"
+            ]
+        )
+        self.assertEqual(read_head(response).oembed, "/oembed?url=x")
+
+    def test_oembed_processor(self):
+        """Known sites are described from their oEmbed endpoint"""
+        self.plugin.resolver.resolve = MagicMock(return_value=["93.184.216.34"])
+        oembed = make_response(
+            chunks=[
+                b'{"title": "Track", "author_name": "Band", '
+                b'"provider_name": "SoundCloud"}'
+            ]
+        )
+        session = MagicMock()
+        session.get.return_value = oembed
+        url = "https://soundcloud.com/band/track"
+        self.assertEqual(
+            self.plugin._run_processors(session, url),
+            (["“Track”", "by", "Band", "— SoundCloud"], "oembed"),
+        )
+        self.assertEqual(session.get.call_args.args, ("https://soundcloud.com/oembed",))
+        self.assertEqual(
+            session.get.call_args.kwargs["params"], {"url": url, "format": "json"}
+        )
+
+        # Without oEmbed data, the page itself is used
+        page = make_response(
+            headers={"Content-Type": "text/html"},
+            chunks=[b"<title>Track by Band</title></head>"],
+        )
+        session.get.side_effect = [make_response(404), page]
+        self.assertEqual(
+            self.plugin._run_processors(session, url), (["“Track by Band”"], "default")
+        )
+
+    def test_api_processors(self):
+        """Heavy sites are described from their JSON APIs"""
+        self.plugin.resolver.resolve = MagicMock(return_value=["93.184.216.34"])
+        for url, api_url, data, expected in [
+            (
+                "https://en.m.wikipedia.org/wiki/Python_(programming_language)",
+                "https://en.wikipedia.org/api/rest_v1/page/summary/"
+                "Python_(programming_language)",
+                {"title": "Python", "description": "Programming language"},
+                (["“Python”", "— Programming language"], "wikipedia"),
+            ),
+            (
+                "https://github.com/thomwiggers/onebot",
+                "https://api.github.com/repos/thomwiggers/onebot",
+                {
+                    "full_name": "thomwiggers/onebot",
+                    "description": "An IRC bot",
+                    "stargazers_count": 20,
+                    "language": "Python",
+                },
+                (["thomwiggers/onebot:", "An IRC bot", "(★ 20, Python)"], "github"),
+            ),
+            (
+                "https://github.com/thomwiggers/onebot/pull/12",
+                "https://api.github.com/repos/thomwiggers/onebot/issues/12",
+                {
+                    "number": 12,
+                    "title": "Fix it",
+                    "state": "open",
+                    "user": {"login": "someone"},
+                    "pull_request": {},
+                },
+                (
+                    ["Pull request #12:", "“Fix it”", "(open)", "by", "someone"],
+                    "github",
+                ),
+            ),
+            (
+                "https://mastodon.social/@someone/1234",
+                "https://mastodon.social/api/v1/statuses/1234",
+                {
+                    "account": {"acct": "someone"},
+                    "content": "<p>Hello <b>world</b></p>",
+                    "media_attachments": [{}],
+                },
+                (
+                    ["@someone@mastodon.social:", "Hello world", "[1 attachments]"],
+                    "mastodon",
+                ),
+            ),
+        ]:
+            with self.subTest(url=url):
+                session = MagicMock()
+                session.get.return_value = make_response(
+                    chunks=[json.dumps(data).encode()]
+                )
+                self.assertEqual(self.plugin._run_processors(session, url), expected)
+                self.assertEqual(session.get.call_args.args, (api_url,))
+
+    def test_api_redirect(self):
+        """Redirects of an API are followed once"""
+        self.plugin.resolver.resolve = MagicMock(return_value=["93.184.216.34"])
+        redirect = make_response(302, {"Location": "United_States"})
+        summary = make_response(
+            chunks=[b'{"title": "United States", "description": "Country"}']
+        )
+        session = MagicMock()
+        session.get.side_effect = [redirect, summary]
+        self.assertEqual(
+            self.plugin._run_processors(session, "https://en.wikipedia.org/wiki/USA"),
+            (["“United States”", "— Country"], "wikipedia"),
+        )
+        self.assertEqual(
+            session.get.call_args.args,
+            ("https://en.wikipedia.org/api/rest_v1/page/summary/United_States",),
+        )
+        session.get.side_effect = [redirect, redirect]
+        self.assertIsNone(
+            self.plugin._fetch_json(session, "https://example.com/api/USA")
+        )
+
+    def test_api_processor_fallback(self):
+        """Pages the APIs do not know are loaded as usual"""
+        self.plugin.resolver.resolve = MagicMock(return_value=["93.184.216.34"])
+        page = make_response(
+            headers={"Content-Type": "text/html"},
+            chunks=[b"<title>Not Mastodon</title></head>"],
+        )
+        session = MagicMock()
+        session.get.side_effect = [make_response(404), page]
+        self.assertEqual(
+            self.plugin._run_processors(session, "https://example.com/@blog/2024"),
+            (["“Not Mastodon”"], "default"),
+        )
+        session.get.side_effect = [page]
+        self.assertEqual(
+            self.plugin._run_processors(session, "https://github.com/features"),
+            (["“Not Mastodon”"], "default"),
+        )
+
+    def test_read_body_budget(self):
+        response = make_response(chunks=[b"a" * 10, b"b" * 10])
+        self.assertEqual(_read_body(response, 100), (20, b"a" * 10 + b"b" * 10))
+        self.assertEqual(_read_body(response, 15), (-1, b"a" * 10 + b"b" * 5))
+
+    def test_read_compressed(self):
+        document = b"<html><head><title>Compressed</title></head>" + b" " * 100000
+        deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        for encoding, body in [
+            ("gzip", gzip.compress(document)),
+            ("deflate", zlib.compress(document)),
+            ("deflate", deflate.compress(document) + deflate.flush()),
+        ]:
+            with self.subTest(encoding=encoding):
+                head = read_head(compressed_response(encoding, body))
+                self.assertEqual(head.title, "Compressed")
+                self.assertEqual(
+                    _read_body(compressed_response(encoding, body), 200000),
+                    (len(document), document),
+                )
+        self.assertIsNone(read_head(compressed_response("br", b"junk")).title)
+
+    def test_decompressed_size_bounded(self):
+        """A compression bomb is not inflated past the budget"""
+        bomb = gzip.compress(b"\0" * (64 * 1048576))
+        self.assertLess(len(bomb), 100000)
+        chunks = list(_iter_decoded(compressed_response("gzip", bomb), 16384, 50000))
+        self.assertEqual(sum(map(len, chunks)), 50000)
+        self.assertLessEqual(max(map(len, chunks)), 16384)
+        self.assertEqual(
+            _read_body(compressed_response("gzip", bomb), 1000), (-1, b"\0" * 1000)
+        )
+
+    def test_compressed_read_errors(self):
+        """Errors while reading a compressed body are those of requests"""
+        for error, expected in [
+            (
+                urllib3.exceptions.ReadTimeoutError(None, "/", "timed out"),
+                requests.exceptions.Timeout,
+            ),
+            (
+                urllib3.exceptions.ProtocolError("Connection broken"),
+                requests.exceptions.ChunkedEncodingError,
+            ),
+            (urllib3.exceptions.SSLError("bad record"), requests.exceptions.SSLError),
+        ]:
+            with self.subTest(error=error):
+                response = make_response(headers={"Content-Encoding": "gzip"})
+                response.raw = MagicMock()
+                response.raw.stream.side_effect = error
+                with self.assertRaises(expected):
+                    _read_body(response, 1000)
+        response = make_response(
+            headers={"Content-Type": "text/html", "Content-Encoding": "gzip"}
+        )
+        response.raw = MagicMock()
+        response.raw.stream.side_effect = urllib3.exceptions.ReadTimeoutError(
+            None, "/", "timed out"
+        )
+        session = MagicMock()
+        session.get.return_value = response
+        with self.assertRaises(UrlErrorException) as cm:
+            self.plugin._process_url_default(session, "https://slow.example/")
+        self.assertEqual(cm.exception.message, "Timeout")
+        self.assertEqual(self.plugin.breakers.last_error("slow.example"), "Timeout")
+
+    def test_size_from_probes(self):
+        """Binary files are never downloaded to find out their size"""
+        body = make_response(headers={"Content-Type": "application/zip"})
+        body.iter_content.side_effect = AssertionError("Should not read the body")
+        for head, probe, expected in [
+            (
+                make_response(headers={"Content-Length": "2048"}),
+                None,
+                ["Content-Type:", "application/zip", "Filesize:", "2.0KiB"],
+            ),
+            (
+                make_response(405),
+                make_response(206, {"Content-Range": "bytes 0-0/3145728"}),
+                ["Content-Type:", "application/zip", "Filesize:", "3.0MiB"],
+            ),
+            (
+                make_response(),
+                make_response(),
+                ["Content-Type:", "application/zip", "Filesize: unknown"],
+            ),
+        ]:
+            with self.subTest(expected=expected):
+                session = MagicMock()
+                session.head.return_value = head
+                session.get.side_effect = [body, probe]
+                self.assertEqual(
+                    self.plugin._process_url_default(
+                        session, "https://example.com/a.zip"
+                    ),
+                    expected,
+                )
+                if probe is not None:
+                    self.assertEqual(
+                        session.get.call_args.kwargs["headers"],
+                        {"Range": "bytes=0-0", "Accept-Encoding": "identity"},
+                    )
+
+    def test_compressed_size_not_reported(self):
+        """The Content-Length of a compressed response is not the file size"""
+        body = make_response(
+            headers={
+                "Content-Type": "text/csv",
+                "Content-Encoding": "gzip",
+                "Content-Length": "10",
+            }
+        )
+        session = MagicMock()
+        session.get.return_value = body
+        session.head.return_value = make_response(headers={"Content-Length": "8388608"})
+        self.assertEqual(
+            self.plugin._process_url_default(session, "https://example.com/a.csv"),
+            ["Content-Type:", "text/csv", "Filesize:", "8.0MiB"],
+        )
+        self.assertEqual(
+            session.head.call_args.kwargs["headers"], {"Accept-Encoding": "identity"}
+        )
+
+    def test_image_size(self):
+        jpeg = (
+            b"\xff\xd8"
+            + b"\xff\xe0\x00\x10JFIF\x00"
+            + b"\x00" * 9
+            + b"\xff\xc0\x00\x11\x08"
+            + struct.pack(">HH", 600, 800)
+        )
+        vp8 = b"RIFF\0\0\0\0WEBPVP8 " + b"\0" * 10 + struct.pack("<HH", 300, 200)
+        vp8l = b"RIFF\0\0\0\0WEBPVP8L\0\0\0\0\x2f" + (
+            (299 | 199 << 14).to_bytes(4, "little")
+        )
+        for data, expected in [
+            (jpeg, (800, 600)),
+            (vp8, (300, 200)),
+            (vp8l, (300, 200)),
+            (jpeg[:20], None),
+            (b"<svg>", None),
+        ]:
+            with self.subTest(data=data[:16]):
+                self.assertEqual(_image_size(data), expected)
+
+    def test_media_info(self):
+        """Media files are described from only their first bytes"""
+        png = b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR" + struct.pack(">II", 640, 480)
+        mvhd = struct.pack(">I4sB3x4I", 28, b"mvhd", 0, 0, 0, 600, 600 * 3725)
+        moov = struct.pack(">I4s", 36, b"moov") + mvhd
+        mdat = struct.pack(">I4s", 1000000, b"mdat") + b"\0" * 100
+        pdf = b"%PDF-1.5\n1 0 obj <</Linearized 1/N 3>>\n2 0 obj <</Title (Report)>>"
+        for content_type, ranges, expected in [
+            (
+                "image/png",
+                {0: png},
+                ["Dimensions:", "640×480", "Filesize:", "2.0MiB"],
+            ),
+            (
+                "video/mp4",
+                {0: mdat, 1000000: moov},
+                ["Duration:", "1h2m5s", "Filesize:", "2.0MiB"],
+            ),
+            (
+                "application/pdf",
+                {0: pdf},
+                ["“Report”", "3 pages", "Filesize:", "2.0MiB"],
+            ),
+        ]:
+            with self.subTest(content_type=content_type):
+                headers = {"Content-Type": content_type}
+                if content_type != "video/mp4":
+                    # Otherwise the size is found from the ranged request
+                    headers["Content-Length"] = "2097152"
+                body = make_response(headers=headers, chunks=[ranges[0]])
+
+                def get(url, headers=None, **kwargs):
+                    if headers is None or "Range" not in headers:
+                        return body
+                    body.close.assert_called()
+                    start = int(headers["Range"][6:].split("-")[0])
+                    return make_response(
+                        206,
+                        {"Content-Range": f"bytes {start}-{start + 99}/2097152"},
+                        [ranges[start]],
+                    )
+
+                session = MagicMock()
+                session.get.side_effect = get
+                self.assertEqual(
+                    self.plugin._process_url_default(session, "https://example.com/a"),
+                    ["Content-Type:", content_type] + expected,
+                )
+                self.assertEqual(session.get.call_count, len(ranges))
+                session.head.assert_not_called()
+
+    def test_media_info_parse_error(self):
+        """Files that can not be parsed are described by their type only"""
+        session = MagicMock()
+        session.get.return_value = make_response(
+            headers={"Content-Type": "image/png", "Content-Length": "8388608"},
+            chunks=[b"\x89PNG"],
+        )
+        with patch(
+            "onebot.plugins.urlinfo._image_size", side_effect=struct.error("short")
+        ):
+            self.assertEqual(
+                self.plugin._process_url_default(session, "https://example.com/a"),
+                ["Content-Type:", "image/png", "Filesize:", "8.0MiB"],
+            )
+
+    def test_ignored_type_not_probed(self):
+        """Small ignored types are skipped on their headers alone"""
+        body = make_response(
+            headers={"Content-Type": "image/svg+xml", "Content-Length": "1024"}
+        )
+        body.iter_content.side_effect = AssertionError("Should not read the body")
+        session = MagicMock()
+        session.get.return_value = body
+        self.assertEqual(
+            self.plugin._process_url_default(session, "https://example.com/a.svg"), []
+        )
+        session.head.assert_not_called()
+
+    def test_batch_lookup(self):
+        fetch = MagicMock(side_effect=lambda keys: {k: [k.upper()] for k in keys})
+        batches = BatchLookup(fetch, UrlCache(), window=0.05, max_batch=2)
+        results = {}
+
+        def get(key):
+            results[key] = batches.get(key)
+
+        threads = [threading.Thread(target=get, args=(key,)) for key in "abca"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {"a": ["A"], "b": ["B"], "c": ["C"]})
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(batches.get("b"), ["B"])
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_youtube_batched(self):
+        response = make_response()
+        response.json.return_value = {
+            "items": [
+                {
+                    "id": video_id,
+                    "snippet": {"title": f"Video {video_id}", "channelTitle": "Chan"},
+                    "contentDetails": {"duration": "PT3M33S"},
+                }
+                for video_id in ["abc", "def"]
+            ]
+        }
+        self.plugin.session = MagicMock()
+        self.plugin.session.get.return_value = response
+        self.plugin.youtube_videos.window = 0.1
+        self.plugin.resolver.resolve = MagicMock(return_value=["1.1.1.1"])
+        urls = [
+            "https://youtu.be/abc",
+            "https://www.youtube.com/watch?v=def",
+            "https://www.youtube.com/shorts/xyz",
+        ]
+        self.bot.privmsg = MagicMock()
+        run_in_new_loop(self.plugin._process_message("#chan", urls))
+        self.bot.privmsg.assert_called_once_with(
+            "#chan",
+            "(1) “Video abc” (3m33s) — Chan (2) “Video def” (3m33s) — Chan "
+            "(3) Video not found.",
+        )
+        self.plugin.session.get.assert_called_once()
+        ids = self.plugin.session.get.call_args.kwargs["params"]["id"]
+        self.assertEqual(sorted(ids.split(",")), ["abc", "def", "xyz"])
+
+    def test_host_breakers(self):
+        breakers = HostBreakers(threshold=2, cooldown=0.05)
+        self.assertTrue(breakers.allow("slow.example"))
+        breakers.failure("slow.example", "Timeout", 4.0)
+        self.assertTrue(breakers.allow("slow.example"))
+        breakers.failure("slow.example", "Timeout", 4.0)
+        self.assertFalse(breakers.allow("slow.example"))
+        self.assertTrue(breakers.allow("fast.example"))
+        self.assertEqual(breakers.last_error("slow.example"), "Timeout")
+        self.assertEqual(
+            breakers.stats(), "Breakers: slow.example open (2 failures, 4.0s)"
+        )
+        time.sleep(0.06)
+        # A single probe is let through
+        self.assertTrue(breakers.allow("slow.example"))
+        self.assertFalse(breakers.allow("slow.example"))
+        breakers.failure("slow.example", "Timeout", 4.0)
+        self.assertFalse(breakers.allow("slow.example"))
+        time.sleep(0.06)
+        self.assertTrue(breakers.allow("slow.example"))
+        breakers.success("slow.example", 0.5)
+        self.assertTrue(breakers.allow("slow.example"))
+        self.assertEqual(breakers.stats(), "Breakers: all closed")
+
+    def test_breaker_skips_requests(self):
+        session = MagicMock()
+        session.get.side_effect = requests.exceptions.Timeout()
+        for _ in range(3):
+            with self.assertRaises(UrlErrorException):
+                self.plugin._process_url_default(session, "https://slow.example/")
+        with self.assertRaises(UrlErrorException) as cm:
+            self.plugin._process_url_default(session, "https://slow.example/a")
+        self.assertEqual(cm.exception.message, "Timeout")
+        self.assertEqual(session.get.call_count, 3)
+        self.bot.dispatch(":im!the@boss PRIVMSG #chan :!urlinfo breakers")
+        self.assertSent(
+            ["PRIVMSG #chan :Breakers: slow.example open (3 failures, 0.0s)"]
+        )
+
+    def test_breaker_probe_error(self):
+        """A probe that fails in an unexpected way does not block the host"""
+        self.plugin.breakers = HostBreakers(threshold=1, cooldown=0)
+        self.plugin.breakers.failure("odd.example", "Timeout", 4.0)
+        session = MagicMock()
+        session.get.return_value = make_response(headers={"Content-Type": "odd"})
+        with self.assertRaises(ValueError):
+            self.plugin._process_url_default(session, "https://odd.example/")
+        self.assertEqual(
+            self.plugin.breakers.last_error("odd.example"), "Request failed"
+        )
+        self.assertTrue(self.plugin.breakers.allow("odd.example"))
+
+    def test_redirect_cache(self):
+        self.plugin.resolver.resolve = MagicMock(return_value=["1.1.1.1"])
+        for status, ttl in [(301, 86400), (302, 600)]:
+            with self.subTest(status=status):
+                redirect = make_response(status)
+                redirect.next = MagicMock(url="https://example.com/article")
+                page = make_response(
+                    headers={"Content-Type": "text/html"},
+                    chunks=[b"<title>Article</title>"],
+                )
+                session = MagicMock()
+                session.get.side_effect = [redirect, page, page]
+                short_url = f"https://sho.rt/{status}"
+                for _ in range(2):
+                    self.assertEqual(
+                        self.plugin._process_url(session, short_url), ["“Article”"]
+                    )
+                article = "https://example.com/article"
+                self.assertEqual(
+                    [c.args[0] for c in session.get.call_args_list],
+                    [short_url, article, article],
+                )
+                now = time.monotonic()
+                with patch("time.monotonic", return_value=now + ttl - 1):
+                    self.assertEqual(
+                        self.plugin.redirect_cache.get(short_url), [article]
+                    )
+                with patch("time.monotonic", return_value=now + ttl + 1):
+                    self.assertIsNone(self.plugin.redirect_cache.get(short_url))
+
     def test_twitter(self):
         with requests.Session() as session:
             for url in [
@@ -155,6 +1320,52 @@ class UrlInfoTestCase(BotTestCase):
                         title = " ".join(result)
                         self.assertEqual(title, expected_title)
 
+    def test_reddit_info_cached(self):
+        comment = MagicMock(spec=praw.models.Comment)
+        comment.subreddit_name_prefixed = "r/crypto"
+        comment.author = MagicMock()
+        comment.author.name = "Natanael_L"
+        comment.link_id = "t3_5vqe47"
+        submission = MagicMock(spec=praw.models.Submission)
+        submission.subreddit_name_prefixed = "r/crypto"
+        submission.author = MagicMock()
+        submission.author.name = "davidw_-"
+        submission.title = "Announcing the first SHA1 collision"
+        things = {"t1_de3ywos": comment, "t3_5vqe47": submission}
+        self.plugin.praw = MagicMock()
+        self.plugin.praw.info.side_effect = lambda fullnames: [
+            things[name] for name in fullnames if name in things
+        ]
+        url = "https://www.reddit.com/r/crypto/comments/5vqe47/announcing/de3ywos/"
+        for _ in range(2):
+            self.assertEqual(
+                " ".join(self.plugin._process_url_reddit(None, url, urlsplit(url))),
+                "/r/crypto comment by Natanael_L on "
+                "“Announcing the first SHA1 collision”",
+            )
+        url = "https://www.reddit.com/r/crypto/comments/5vqe47/announcing/"
+        self.assertEqual(
+            " ".join(self.plugin._process_url_reddit(None, url, urlsplit(url))),
+            "/r/crypto: “Announcing the first SHA1 collision” by /u/davidw_-",
+        )
+        self.assertEqual(self.plugin.praw.info.call_count, 2)
+
+        url = "https://www.reddit.com/r/crypto/comments/aaaaaa/gone/"
+        self.assertEqual(
+            self.plugin._process_url_reddit(None, url, urlsplit(url)),
+            ["Submission not found"],
+        )
+
+    def test_reddit_deadline(self):
+        release = threading.Event()
+        self.plugin.praw = MagicMock()
+        self.plugin.praw.info.side_effect = lambda fullnames: release.wait(5) and []
+        self.plugin.reddit_timeout = 0.1
+        url = "https://www.reddit.com/r/crypto/comments/5vqe47/announcing/"
+        with self.assertRaises(UrlErrorException):
+            self.plugin._process_url_reddit(None, url, urlsplit(url))
+        release.set()
+
     @unittest.skipIf("praw_client_id" not in os.environ, "No credentials provided")
     def test_reddit(self):
         with requests.Session() as session: